@@ -1,30 +1,59 @@
-from gevent import monkey
+import time
+
+# Startup timing marks, reported per phase when the server starts
+startup_marks = [('start', time.perf_counter())]
+
+from gevent import monkey, getcurrent, get_hub
 from gevent.wsgi import WSGIServer
 monkey.patch_all()
+startup_marks.append(('import gevent', time.perf_counter()))
+
 import os
 import requests
 from datetime import datetime, timedelta
 import redis
 import traceback
 import math
-import time
 import json
+import sys
+import pickle
+import tempfile
+import gzip
+import hashlib
+import hmac
+import mmap
+import gc
+import tracemalloc
+import types
+import struct
+import re as regex
 import jwt
-from fuzzywuzzy import process, fuzz
-from flask import Flask, Response, request, jsonify, current_app, redirect, url_for, session
+from functools import wraps, lru_cache
+from collections import Counter, OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heappop
+from urllib.parse import urlparse
+startup_marks.append(('import stdlib, requests, redis, jwt', time.perf_counter()))
+
+import numpy as np
+startup_marks.append(('import numpy', time.perf_counter()))
+
+from flask import Flask, Response, request, jsonify, current_app, redirect, url_for, session, g, has_request_context
 from flask_cors import CORS
-from flask_oauthlib.client import OAuth
 from werkzeug.contrib.fixers import ProxyFix
 from werkzeug.security import gen_salt
-from pymongo import MongoClient, DESCENDING
+startup_marks.append(('import flask', time.perf_counter()))
+
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.collection import Collection
 from bson import ObjectId
-from functools import wraps
+startup_marks.append(('import pymongo', time.perf_counter()))
+
 from raven.contrib.flask import Sentry
+startup_marks.append(('import raven', time.perf_counter()))
 
-try:
-    import xml.etree.cElementTree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
+# The OAuth client, fuzzy matcher and XML parser are only needed by a few routes and are imported on first use
 
 # Configuration
 etf_host = 'localhost'
@@ -33,9 +62,332 @@ redirect_host = os.environ.get('ETF_API_OAUTH_REDIRECT', 'http://localhost:3000'
 
 standard_headers = {'user_agent': 'https://eve.exchange'}
 
-mongo_client = MongoClient()
+# Metrics
+# Request latency and status per route, and calls and time spent per backend, exported in the Prometheus text format.
+# Backends are instrumented where their clients are created below, so handlers don't need to record anything
+metrics_latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+metrics_size_buckets = [1, 5, 10, 50, 100, 500, 1000, 5000, 10000]
+
+# Name: (type, help) in the order they're exported
+metrics_help = {
+    'etf_api_request_duration_seconds': ('histogram', "Time spent handling a request"),
+    'etf_api_requests_total': ('counter', "Requests handled by route and HTTP status"),
+    'etf_api_request_errors_total': ('counter', "Requests answered with an error body by route and error code"),
+    'etf_api_backend_calls_total': ('counter', "Calls made to MongoDB, Redis and HTTP backends by route"),
+    'etf_api_backend_seconds_total': ('counter', "Time spent waiting on MongoDB, Redis and HTTP backends by route"),
+    'etf_api_redis_pipeline_commands': ('histogram', "Commands sent per Redis pipeline"),
+    'etf_api_hub_blocked_seconds': ('histogram', "Time a greenlet kept the gevent hub from running other greenlets")
+}
+
+# Keyed by (name, labels) where labels is a tuple of (label, value) pairs
+metrics_counters = {}
+metrics_histograms = {}
+
+def metrics_inc(name, labels, value=1):
+
+    key = (name, labels)
+    metrics_counters[key] = metrics_counters.get(key, 0) + value
+
+def metrics_observe(name, labels, value, buckets=metrics_latency_buckets):
+
+    key = (name, labels)
+    histogram = metrics_histograms.get(key)
+
+    if histogram is None:
+        histogram = metrics_histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0}
+
+    # Counts are kept per bucket and only made cumulative when exported
+    histogram['counts'][bisect_left(buckets, value)] += 1
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+# Route rule of the current request, such as /market/depth/<int:region>/<int:typeid>
+def metrics_route():
+
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+
+    return 'none'
+
+# Records a backend call that started at start. Returns the trace span of the call, which later reads of the
+# same cursor pass back in so they add to it instead of opening a span each
+def metrics_backend(backend, target, start, calls=1, span=None):
+
+    seconds = time.perf_counter() - start
+    labels = (('route', metrics_route()), ('backend', backend), ('target', target))
+
+    if calls:
+        metrics_inc('etf_api_backend_calls_total', labels, calls)
+
+    metrics_inc('etf_api_backend_seconds_total', labels, seconds)
+
+    if trace_slow_log is None or not has_request_context():
+        return None
+
+    return trace_span(backend, target, start, seconds, span)
+
+def _metrics_labels(labels):
+
+    return ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in labels)
+
+def metrics_render():
+
+    lines = []
+
+    for name, (kind, description) in metrics_help.items():
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+        if kind == 'counter':
+            for (key, labels), value in sorted(metrics_counters.items()):
+                if key == name:
+                    lines.append('%s{%s} %s' % (name, _metrics_labels(labels), value))
+            continue
+
+        for (key, labels), histogram in sorted(metrics_histograms.items(), key=lambda item: item[0]):
+            if key != name:
+                continue
+
+            total = 0
+
+            for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                total += count
+                lines.append('%s_bucket{%s} %s' % (name, _metrics_labels(labels + (('le', bound),)), total))
+
+            lines.append('%s_sum{%s} %s' % (name, _metrics_labels(labels), histogram['sum']))
+            lines.append('%s_count{%s} %s' % (name, _metrics_labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+# Tracing
+# Every request gets a trace ID, taken from the X-Trace-Id header when the caller sends a valid one.
+# When ETF_API_SLOW_LOG is set, backend calls are kept as spans and requests slower than ETF_API_SLOW_LOG_MS
+# are appended to that file as one JSON object per line. Otherwise no spans are recorded
+trace_slow_log = os.environ.get('ETF_API_SLOW_LOG') or None
+trace_slow_threshold = float(os.environ.get('ETF_API_SLOW_LOG_MS', 1000)) / 1000
+trace_span_limit = 1000 # Spans kept per request, later calls are only counted
+trace_id_pattern = regex.compile(r'[0-9A-Za-z_-]{1,64}')
+trace_slow_file = None
+
+def trace_start():
+
+    trace_id = request.headers.get('X-Trace-Id', '')
+
+    g.trace_id = trace_id if trace_id_pattern.fullmatch(trace_id) else os.urandom(8).hex()
+    g.trace_spans = [] if trace_slow_log is not None else None
+    g.trace_dropped = 0
+
+def trace_span(backend, target, start, seconds, span=None):
+
+    if span is None:
+        spans = g.get('trace_spans')
+
+        if spans is None:
+            return None
+
+        # Dropped spans still take the time of later cursor reads so they're only counted once
+        if len(spans) >= trace_span_limit:
+            g.trace_dropped += 1
+            return {'seconds': 0}
+
+        span = {'backend': backend, 'target': target, 'start': start, 'seconds': 0}
+        spans.append(span)
+
+    span['seconds'] += seconds
+
+    return span
+
+def trace_slow_request(status, elapsed):
+
+    backends = {}
+    spans = []
+
+    for span in g.get('trace_spans') or []:
+        backends[span['backend']] = backends.get(span['backend'], 0) + span['seconds'] * 1000
+
+        entry = {
+            'backend': span['backend'],
+            'target': span['target'],
+            'startMs': round((span['start'] - g.metrics_start) * 1000, 3),
+            'durationMs': round(span['seconds'] * 1000, 3)
+        }
+
+        if 'commands' in span:
+            entry['commands'] = span['commands']
+
+        spans.append(entry)
+
+    entry = {
+        'time': datetime.utcnow().isoformat(),
+        'traceId': g.trace_id,
+        'method': request.method,
+        'route': metrics_route(),
+        'path': request.path,
+        'query': request.query_string.decode('utf-8', 'replace'),
+        'status': status,
+        'durationMs': round(elapsed * 1000, 3),
+        'backendMs': {backend: round(ms, 3) for backend, ms in backends.items()},
+        'spans': spans,
+        'spansDropped': g.trace_dropped
+    }
+
+    trace_write(entry)
+
+def trace_write(entry):
+    global trace_slow_file
+
+    try:
+        if trace_slow_file is None:
+            trace_slow_file = open(trace_slow_log, 'a', buffering=1)
+
+        trace_slow_file.write(json.dumps(entry) + '\n')
+    except:
+        traceback.print_exc()
+
+def _metrics_timed(backend, target, fn):
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+
+        start = time.perf_counter()
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            metrics_backend(backend, target, start)
+
+    return wrapper
+
+# MongoDB
+# pymongo 2.9 has no command monitoring, so the database hands out proxies of its collections and their cursors.
+# Queries only run when a cursor is read, so the first batch counts as the call and every read adds its time
+metrics_mongo_calls = {'find_one', 'find_and_modify', 'insert', 'update', 'remove', 'save', 'count', 'distinct', 'aggregate', 'create_index', 'ensure_index', 'drop'}
+metrics_cursor_chain = {'sort', 'limit', 'skip', 'batch_size', 'hint', 'max_time_ms'}
+
+class MetricsCursor(object):
+
+    def __init__(self, cursor, target):
+        self._cursor = cursor
+        self._target = target
+        self._started = False
+        self._span = None
+
+    def __getattr__(self, name):
+
+        attr = getattr(self._cursor, name)
+
+        if name in metrics_cursor_chain:
+            def chain(*args, **kwargs):
+                attr(*args, **kwargs)
+                return self
+
+            return chain
+
+        if name in ('count', 'distinct', 'explain'):
+            return _metrics_timed('mongo', self._target, attr)
+
+        return attr
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+
+        start = time.perf_counter()
+
+        try:
+            return next(self._cursor)
+        finally:
+            self._span = metrics_backend('mongo', self._target, start, 0 if self._started else 1, self._span)
+            self._started = True
+
+class MetricsCollection(object):
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+
+        attr = getattr(self._collection, name)
+
+        if name == 'find':
+            return lambda *args, **kwargs: MetricsCursor(attr(*args, **kwargs), self._collection.name)
+
+        if name in metrics_mongo_calls:
+            return _metrics_timed('mongo', self._collection.name, attr)
+
+        return attr
+
+class MetricsDatabase(object):
+
+    def __init__(self, database):
+        self._database = database
+
+    def __getattr__(self, name):
+
+        attr = getattr(self._database, name)
+
+        return MetricsCollection(attr) if isinstance(attr, Collection) else attr
+
+    def __getitem__(self, name):
+        return MetricsCollection(self._database[name])
+
+# Redis
+# Commands are timed by name. Pipelined commands are only sent on execute, which is timed as a single call
+class MetricsRedis(redis.StrictRedis):
+
+    def execute_command(self, *args, **options):
+
+        start = time.perf_counter()
+
+        try:
+            return super(MetricsRedis, self).execute_command(*args, **options)
+        finally:
+            metrics_backend('redis', str(args[0]).upper(), start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+
+        pipe = super(MetricsRedis, self).pipeline(transaction, shard_hint)
+        execute = pipe.execute
+
+        def timed_execute(*args, **kwargs):
+
+            size = len(pipe.command_stack)
+            start = time.perf_counter()
+
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                span = metrics_backend('redis', 'PIPELINE', start)
+
+                if span is not None:
+                    span['commands'] = size
+
+                metrics_observe('etf_api_redis_pipeline_commands', (('route', metrics_route()),), size, metrics_size_buckets)
 
-mongo_db = mongo_client.eveexchange
+        pipe.execute = timed_execute
+
+        return pipe
+
+# HTTP
+# requests.get and requests.post go through Session.request, so the backend publisher and EVE APIs are timed by host
+_metrics_session_request = requests.Session.request
+
+def metrics_session_request(self, method, url, *args, **kwargs):
+
+    start = time.perf_counter()
+
+    try:
+        return _metrics_session_request(self, method, url, *args, **kwargs)
+    finally:
+        metrics_backend('http', urlparse(url).netloc, start)
+
+requests.Session.request = metrics_session_request
+
+# Connections are opened on first query rather than at import
+mongo_client = MongoClient(_connect=False)
+
+mongo_db = MetricsDatabase(mongo_client.eveexchange)
 
 settings_collection = mongo_db.settings
 portfolio_collection = mongo_db.portfolios
@@ -48,6 +400,95 @@ aggregates_hourly = mongo_db.aggregates_hourly
 aggregates_daily = mongo_db.aggregates_daily
 user_orders_collection = mongo_db.user_orders
 alerts_collection = mongo_db.alerts
+portfolio_charts_collection = mongo_db.portfolio_charts
+
+# Indexes backing every query made by this service as (collection, keys, options)
+# Applied by ensure_indexes() on start and by `python server.py ensure-indexes`
+index_manifest = [
+    ('settings', [('user_id', ASCENDING)], {}),
+    ('settings', [('api_key', ASCENDING)], {}),
+    ('users', [('user_id', ASCENDING)], {}),
+    ('subscription', [('user_id', ASCENDING)], {}),
+    ('portfolios', [('user_id', ASCENDING), ('portfolioID', ASCENDING)], {}),
+    ('portfolios', [('portfolioID', DESCENDING)], {}),
+    ('portfolio_charts', [('portfolioID', ASCENDING), ('frequency', ASCENDING), ('bucket', ASCENDING)], {'unique': True}),
+    ('orders', [('region', ASCENDING), ('buy', ASCENDING)], {}),
+    ('aggregates_minutes', [('type', ASCENDING), ('time', ASCENDING)], {}),
+    ('aggregates_minutes', [('time', DESCENDING)], {}),
+    ('aggregates_hourly', [('type', ASCENDING), ('time', ASCENDING)], {}),
+    ('aggregates_daily', [('type', ASCENDING), ('time', ASCENDING)], {}),
+    ('alerts', [('user_id', ASCENDING), ('_id', DESCENDING)], {}),
+    ('alerts', [('alertType', ASCENDING), ('paused', ASCENDING), ('user_id', ASCENDING)], {}),
+    ('alerts', [('alertType', ASCENDING), ('updatedAt', ASCENDING)], {}),
+    ('notifications', [('user_id', ASCENDING), ('_id', DESCENDING)], {}),
+    ('user_orders', [('user_id', ASCENDING), ('_id', DESCENDING)], {}),
+    ('user_orders', [('user_id', ASCENDING), ('updatedAt', ASCENDING)], {})
+]
+
+ensure_indexes_on_start = os.environ.get('ETF_API_ENSURE_INDEXES', 'true') == 'true'
+
+# Queries
+
+# Filters and sorts used by the routes. query_plan_checks explains the same definitions, so a query that
+# loses its index fails `python server.py check-query-plans` and tests/test_query_plans.py
+def user_query(user_id):
+    return {'user_id': user_id}
+
+def users_query(user_ids):
+    return {'user_id': {'$in': user_ids}}
+
+def api_key_query(api_key):
+    return {'api_key': api_key}
+
+def portfolio_query(user_id, portfolioID):
+    return {'user_id': user_id, 'portfolioID': portfolioID}
+
+next_portfolio_sort = [('portfolioID', DESCENDING)]
+
+def portfolio_chart_query(portfolioID, frequency, start_bucket, end):
+    return {'portfolioID': portfolioID, 'frequency': frequency, 'bucket': {'$gte': start_bucket, '$lte': end}}
+
+portfolio_chart_sort = [('bucket', ASCENDING)]
+
+def region_orders_query(region, buy):
+    return {'region': region, 'buy': buy}
+
+def history_query(typeID):
+    return {'type': typeID}
+
+history_sort = [('time', ASCENDING)]
+
+latest_aggregate_sort = [('time', DESCENDING)]
+
+def alert_query(user_id, alert_id):
+    return {'user_id': user_id, '_id': ObjectId(oid=alert_id)}
+
+# Alerts of a type that aren't paused, optionally only for some users
+def active_alerts_query(alert_type, user_ids=None):
+
+    query = {'alertType': alert_type, 'paused': False}
+
+    if user_ids is not None:
+        query['user_id'] = {'$in': user_ids}
+
+    return query
+
+# Alerts of a type written since a time, paused ones included
+def changed_alerts_query(alert_type, since):
+    return {'alertType': alert_type, 'updatedAt': {'$gte': since}}
+
+# Orders of the given users written since a time
+def changed_orders_query(user_ids, since):
+    return {'user_id': {'$in': user_ids}, 'updatedAt': {'$gte': since}}
+
+def unread_notifications_query(user_id):
+    return {'user_id': user_id, 'read': False}
+
+# Pages are sorted newest first and continue below the _id of the cursor
+def page_query(query, cursor):
+    return query if cursor is None else dict(query, _id={'$lt': cursor})
+
+page_sort = [('_id', DESCENDING)]
 
 portfolio_limit = 100 # Max number of portfolios a user can have
 portfolio_component_limit = 25 # number of components per portfolio
@@ -55,158 +496,920 @@ profile_free_limit = 5
 profile_premium_limit = 15
 supported_regions = [10000002, 10000043, 10000032, 10000042, 10000030]
 
-port = int(os.environ.get('ETF_API_PORT', 5000))
-env = os.environ.get('ETF_API_ENV', 'development')
+port = int(os.environ.get('ETF_API_PORT', 5000))
+env = os.environ.get('ETF_API_ENV', 'development')
+
+debug = False if env == 'production' else True
+
+auth_jwt_secret = 'development' if debug else os.environ.get('ETF_API_JWT_SECRET', 'production')
+
+# Use to connect to private backend publishing API
+admin_secret = os.environ.get('ETF_API_ADMIN_SECRET', 'admin_secret')
+
+# Application
+app = Flask(__name__)
+app.wsgi_app = ProxyFix(app.wsgi_app)
+app.secret_key = os.environ.get('ETF_API_JWT_SECRET', 'production')
+CORS(app)
+
+# Single sign on service, created on first use
+evesso = None
+
+def get_evesso():
+    global evesso
+
+    if evesso is not None:
+        return evesso
+
+    from flask_oauthlib.client import OAuth
+
+    oauth = OAuth(app)
+    remote = oauth.remote_app('evesso',
+        consumer_key=os.environ.get('ETF_API_OAUTH_KEY', 'example'),
+        consumer_secret=os.environ.get('ETF_API_OAUTH_SECRET', 'example'),
+        request_token_params={
+            'scope': '',
+            'state': lambda: session['evesso_state']
+        },
+        base_url='https://login.eveonline.com/',
+        request_token_url=None,
+        access_token_method='POST',
+        access_token_url='https://login.eveonline.com/oauth/token',
+        authorize_url='https://login.eveonline.com/oauth/authorize'
+    )
+
+    remote.tokengetter(get_evesso_oauth_token)
+
+    evesso = remote
+
+    return evesso
+
+# Sentry exception tracking
+app.config['SENTRY_CONFIG'] = {
+    'ignore_exceptions': ['KeyboardInterrupt'],
+}
+sentry = Sentry(app, dsn='dsn' if env == 'production' else None)
+
+startup_marks.append(('application and sentry', time.perf_counter()))
+
+# SDE
+# Parsed SDE structures are cached in a binary snapshot so workers don't reparse the JSON sources or hit the network on boot
+# The snapshot is rebuilt whenever one of the sources changes size or modification time
+sde_sources = {
+    'blueprints': 'sde/blueprints.js',
+    'market_groups': 'sde/market_groups.js',
+    'market_id_to_volume': 'sde/market_id_to_volume.json',
+    'system_names': 'sde/system_names.json'
+}
+
+sde_snapshot_path = os.environ.get('ETF_API_SDE_SNAPSHOT', 'sde/snapshot.pickle')
+sde_snapshot_version = 5
+
+# Blueprints are kept out of the snapshot in a compact file that every worker memory maps
+blueprint_catalog_path = os.environ.get('ETF_API_BLUEPRINT_CATALOG', 'sde/blueprints.bin')
+
+# Header: magic, version, product count, material count, name bytes, sha1 of the blueprints source JSON
+blueprint_catalog_header = struct.Struct('<4sIIII40s')
+blueprint_catalog_magic = b'EXBP'
+blueprint_catalog_version = 1
+
+def _sde_fingerprint():
+    return {name: (os.stat(path).st_size, os.stat(path).st_mtime) for name, path in sde_sources.items()}
+
+# Every writer gets its own temp file next to the target, so workers building at the same time can't interleave
+def _sde_replace(path, write):
+
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+def _sde_read_json(name):
+    with open(sde_sources[name], 'r', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+# Dense type catalog shared by the market code
+# Market items come first in market group order so every group subtree covers a contiguous range of rows,
+# followed by any blueprint products or materials that can't be traded on the market
+def _sde_type_catalog(market_groups, blueprints):
+
+    type_ids = []
+    group_bits = {}
+
+    def _getGroups(group):
+        start = len(type_ids)
+
+        if 'items' in group:
+            type_ids.extend(int(x['id']) for x in group['items'])
+
+        for _group in group['childGroups']:
+            _getGroups(_group)
+
+        # Bitset of catalog rows for every item in this group and its children
+        group_bits[group['id']] = ((1 << (len(type_ids) - start)) - 1) << start
+
+    for group in market_groups:
+        _getGroups(group)
+
+    market_type_count = len(type_ids)
+    known = set(type_ids)
+    extra = set()
+
+    for product, blueprint in blueprints.items():
+        extra.add(int(product))
+        extra.update(material['typeID'] for material in blueprint.get('materials', []))
+
+    type_ids.extend(sorted(extra - known))
+
+    return {
+        'type_ids': array('i', type_ids),
+        'market_type_count': market_type_count,
+        'group_bits': group_bits
+    }
+
+# Compact JSON for the /sde endpoints, stored gzip compressed with a content hash for the ETag
+def _sde_payload(data):
+
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    return {
+        'etag': hashlib.sha1(raw).hexdigest(),
+        'gzip': gzip.compress(raw, 9)
+    }
+
+# Writes the blueprints as CSR style int32 arrays followed by a utf-8 string table of names:
+#   products[n] (sorted), output[n], offsets[n + 1], material_types[m], material_quantities[m], name_offsets[n + 1], names
+def write_blueprint_catalog(blueprints, etag):
+
+    products = array('i', sorted(int(k) for k in blueprints))
+    output = array('i')
+    offsets = array('i', [0])
+    material_types = array('i')
+    material_quantities = array('i')
+    name_offsets = array('i', [0])
+    names = bytearray()
+
+    for product in products:
+        blueprint = blueprints[str(product)]
+
+        output.append(blueprint['quantity'])
+
+        for material in blueprint.get('materials', []):
+            material_types.append(material['typeID'])
+            material_quantities.append(material['quantity'])
+
+        offsets.append(len(material_types))
+
+        names.extend(blueprint.get('name', '').encode('utf-8'))
+        name_offsets.append(len(names))
+
+    def _write(f):
+        f.write(blueprint_catalog_header.pack(blueprint_catalog_magic, blueprint_catalog_version, len(products), len(material_types), len(names), etag.encode('ascii')))
+
+        for section in (products, output, offsets, material_types, material_quantities, name_offsets):
+            f.write(section.tobytes())
+
+        f.write(names)
+
+    _sde_replace(blueprint_catalog_path, _write)
+
+# Maps the blueprint catalog read only so its pages are shared between worker processes
+# Returns None if the file is missing, truncated or wasn't built from the expected blueprints source
+def load_blueprint_catalog(etag):
+
+    try:
+        with open(blueprint_catalog_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        magic, version, n, m, names_length, _etag = blueprint_catalog_header.unpack_from(mapped)
+    except struct.error:
+        mapped.close()
+        return None
+
+    if magic != blueprint_catalog_magic or version != blueprint_catalog_version or _etag != etag.encode('ascii'):
+        mapped.close()
+        return None
+
+    # Sections are 4 byte ints: products and output (n), offsets (n + 1), material types and quantities (m)
+    # and name offsets (n + 1), followed by the names
+    if len(mapped) != blueprint_catalog_header.size + 4 * (4 * n + 2 + 2 * m) + names_length:
+        mapped.close()
+        return None
+
+    view = memoryview(mapped)
+    catalog = {'mmap': mapped}
+    position = blueprint_catalog_header.size
+
+    for name, count in (('products', n), ('output', n), ('offsets', n + 1), ('material_types', m), ('material_quantities', m), ('name_offsets', n + 1)):
+        catalog[name] = view[position:position + count * 4].cast('i')
+        position += count * 4
+
+    catalog['names'] = view[position:position + names_length]
+
+    return catalog
+
+# ESI replaces the retired CREST /industry/systems/ endpoint
+def fetch_system_names():
+
+    res = requests.get('https://esi.evetech.net/latest/universe/systems/', timeout=10, headers=standard_headers)
+    system_ids = json.loads(res.text)
+    names = {}
+
+    for i in range(0, len(system_ids), 1000):
+        res = requests.post('https://esi.evetech.net/latest/universe/names/', json=system_ids[i:i + 1000], timeout=10, headers=standard_headers)
+
+        for item in json.loads(res.text):
+            names[item['name']] = item['id']
+
+    return names
+
+def build_sde_snapshot(previous=None, refresh_systems=False):
+
+    market_groups = _sde_read_json('market_groups')
+    blueprints = _sde_read_json('blueprints')
+
+    snapshot = {
+        'version': sde_snapshot_version,
+        'fingerprint': _sde_fingerprint(),
+        'market_groups': market_groups,
+        'type_catalog': _sde_type_catalog(market_groups, blueprints),
+        'payloads': {
+            'blueprints': _sde_payload(blueprints),
+            'market_groups': _sde_payload(market_groups)
+        },
+        'market_id_to_volume': {int(k):v for k,v in _sde_read_json('market_id_to_volume').items()},
+        'system_name_to_id': _sde_read_json('system_names')
+    }
+
+    # Solar systems come from the checked in sde/system_names.json plus any newer names an earlier snapshot
+    # fetched from ESI. ESI is only asked on an explicit refresh, and a failed refresh keeps the names we have
+    if previous is not None:
+        snapshot['system_name_to_id'].update(previous.get('system_name_to_id', {}))
+
+    if refresh_systems:
+        try:
+            snapshot['system_name_to_id'].update(fetch_system_names())
+        except:
+            traceback.print_exc()
+
+    snapshot['blueprint_catalog'] = None
+
+    try:
+        write_blueprint_catalog(blueprints, snapshot['payloads']['blueprints']['etag'])
+        snapshot['blueprint_catalog'] = load_blueprint_catalog(snapshot['payloads']['blueprints']['etag'])
+
+        # A snapshot without solar systems isn't saved so the next start reads them again
+        if len(snapshot['system_name_to_id']) > 0:
+            _sde_replace(sde_snapshot_path, lambda f: pickle.dump({k: v for k, v in snapshot.items() if k != 'blueprint_catalog'}, f, protocol=pickle.HIGHEST_PROTOCOL))
+    except:
+        traceback.print_exc()
+
+    if snapshot['blueprint_catalog'] is None:
+        raise Exception("Failed to write the blueprint catalog to %s" % blueprint_catalog_path)
+
+    return snapshot
+
+def load_sde_snapshot():
+
+    snapshot = None
+
+    try:
+        with open(sde_snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except:
+        traceback.print_exc()
+
+    if snapshot is not None and snapshot.get('version') == sde_snapshot_version and snapshot.get('fingerprint') == _sde_fingerprint() and len(snapshot.get('system_name_to_id', {})) > 0:
+
+        snapshot['blueprint_catalog'] = load_blueprint_catalog(snapshot['payloads']['blueprints']['etag'])
+
+        if snapshot['blueprint_catalog'] is not None:
+            return snapshot
+
+    return build_sde_snapshot(snapshot)
+
+_sde = load_sde_snapshot()
+
+blueprint_catalog = _sde['blueprint_catalog']
+market_groups = _sde['market_groups']
+market_id_to_volume = _sde['market_id_to_volume']
+system_name_to_id = _sde['system_name_to_id']
+sde_payloads = _sde['payloads']
+
+type_catalog_ids = _sde['type_catalog']['type_ids']
+type_catalog_market_count = _sde['type_catalog']['market_type_count']
+market_group_bits = _sde['type_catalog']['group_bits']
+type_catalog_rows = {typeID: row for row, typeID in enumerate(type_catalog_ids)}
+
+del _sde
+
+def is_market_type(typeID):
+    return type_catalog_rows.get(typeID, type_catalog_market_count) < type_catalog_market_count
+
+def catalog_rows(bits):
+    return [row for row, bit in enumerate(reversed(bin(bits)[2:])) if bit == '1']
+
+# Market typeIDs in catalog order, optionally restricted to a market group and its children
+def market_type_ids(group=None):
+
+    if group is None:
+        return type_catalog_ids[:type_catalog_market_count]
+
+    return [type_catalog_ids[row] for row in catalog_rows(market_group_bits[group])]
+
+# Blueprint catalog accessors
+def _blueprint_row(typeID):
+
+    products = blueprint_catalog['products']
+    row = bisect_left(products, typeID)
+
+    return row if row < len(products) and products[row] == typeID else -1
+
+def is_blueprint(typeID):
+    return _blueprint_row(typeID) >= 0
+
+def blueprint_products():
+    return blueprint_catalog['products']
+
+def blueprint_quantity(typeID):
+    return blueprint_catalog['output'][_blueprint_row(typeID)]
+
+# List of (typeID, quantity) required for a single run
+def blueprint_materials(typeID):
+
+    row = _blueprint_row(typeID)
+    start, end = blueprint_catalog['offsets'][row], blueprint_catalog['offsets'][row + 1]
+
+    return list(zip(blueprint_catalog['material_types'][start:end], blueprint_catalog['material_quantities'][start:end]))
+
+def blueprint_name(typeID):
+
+    row = _blueprint_row(typeID)
+
+    return bytes(blueprint_catalog['names'][blueprint_catalog['name_offsets'][row]:blueprint_catalog['name_offsets'][row + 1]]).decode('utf-8')
+
+startup_marks.append(('sde snapshot', time.perf_counter()))
+
+re = None
+
+try:
+    re = MetricsRedis(host=redis_host, port=6379, db=0)
+except:
+    print("Redis server is unavailable")
+    sentry.captureException()
+
+startup_marks.append(('redis client', time.perf_counter()))
+
+# Decorator to validate a JWT and retrieve the users info from rethinkDB
+# Authorization types:
+#   Token <jwt>
+#   Key <api_key>
+def verify_jwt(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+
+        user_settings = None
+
+        try:
+            auth_header = request.headers.get('Authorization')
+
+            if auth_header == None:
+                auth_header = request.headers.get('authorization')
+
+            if auth_header == None:
+                return jsonify({ 'error': "Authorization header is missing", 'code': 400 })
+
+            split = auth_header.split(" ")
+
+            if len(split) != 2:
+                return jsonify({ 'error': "Invalid authorization header format", 'code': 400 })
+
+            if split[0] != "Token" and split[0] != "Key":
+                return jsonify({ 'error': "Authorization header must include 'Token' or 'Key'", 'code': 400 })
+
+            if split[0] == "Token":
+                try:
+                    user_data = jwt.decode(split[1], auth_jwt_secret)
+
+                    user_settings = mongo_db.settings.find_one(user_query(user_data['user_id']))
+                except jwt.exceptions.ExpiredSignatureError:
+                    return jsonify({'error': "Authorization token is expired", 'code': 400})
+                except jwt.exceptions.InvalidTokenError:
+                    return jsonify({'error': "Authorization token is invalid", 'code': 400})
+                except:
+                    return jsonify({'error': "Failed to parse authorization token", 'code': 400})
+
+            elif split[0] == "Key":
+
+                try:
+                    if split[1] is None or len(split[1]) == 0:
+                        return jsonify({'error': "Unable to verify your API key. Please check that it is valid and typed correctly", 'code': 400})
+
+                    user_settings = mongo_db.settings.find_one(api_key_query(split[1]))
+
+                    if user_settings is None:
+                        return jsonify({'error': "Unable to verify your API key. Please check that it is valid and typed correctly", 'code': 400})
+                except:
+                    return jsonify({'error': "Failed to correctly parse api key. Please check that it is valid and typed correctly", 'code': 400})
+        except:
+            traceback.print_exc()
+            return jsonify({ 'error': "Failed to parse authorization header", 'code': 400 })
+
+        if user_settings is None:
+            return jsonify({'error': "Failed to look up user information", 'code': 400})
+
+        user_id = user_settings['user_id']
+
+        return fn(user_id=user_id, settings=user_settings, *args, **kwargs)
+
+    return wrapper
+
+# Decorator for internal endpoints called by the backend
+# Authorization type:
+#   Admin <admin_secret>
+def verify_admin(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+
+        split = request.headers.get('Authorization', '').split(" ")
+
+        # Compared as bytes since compare_digest rejects strings with non-ASCII characters
+        if len(split) != 2 or split[0] != "Admin" or not hmac.compare_digest(split[1].encode('utf-8'), admin_secret.encode('utf-8')):
+            return jsonify({'error': "Admin authorization is required", 'code': 401})
+
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+# Cursor pagination over _id, newest first. The cursor is the _id of the last document on the previous page
+def parse_page_args(default_limit=25, max_limit=100):
+
+    try:
+        cursor = request.args.get('cursor', None)
+        cursor = ObjectId(oid=cursor) if cursor else None
+        limit = int(request.args.get('limit', default_limit))
+    except:
+        raise ValueError("Parameters 'cursor' or 'limit' are invalid")
+
+    if limit <= 0 or limit > max_limit:
+        raise ValueError("Parameter 'limit' must be between 1 and %s" % max_limit)
+
+    return cursor, limit
+
+# Returns the page of documents and the cursor for the next page, or None on the last page
+def paginate(collection, query, cursor, limit, **kwargs):
+
+    docs = list(collection.find(page_query(query, cursor), **kwargs).sort(page_sort).limit(limit + 1))
+
+    if len(docs) > limit:
+        return docs[:limit], str(docs[limit - 1]['_id'])
+
+    return docs, None
+
+# Request metrics
+@app.before_request
+def metrics_before_request():
+    g.metrics_start = time.perf_counter()
+    trace_start()
+
+def metrics_request(status):
+
+    g.metrics_recorded = True
+    route = metrics_route()
+    elapsed = time.perf_counter() - g.metrics_start
+
+    metrics_observe('etf_api_request_duration_seconds', (('method', request.method), ('route', route)), elapsed)
+    metrics_inc('etf_api_requests_total', (('method', request.method), ('route', route), ('status', status)))
+
+    if trace_slow_log is not None and elapsed >= trace_slow_threshold:
+        trace_slow_request(status, elapsed)
+
+@app.after_request
+def metrics_after_request(response):
+
+    if g.get('metrics_start') is None:
+        return response
+
+    metrics_request(str(response.status_code))
+    response.headers['X-Trace-Id'] = g.trace_id
+
+    # Errors are answered with a 200 status and the code in a small JSON body
+    if response.mimetype == 'application/json' and not response.is_streamed and response.content_length is not None and response.content_length < 1024:
+        try:
+            body = json.loads(response.get_data(as_text=True))
+
+            if isinstance(body, dict) and 'error' in body:
+                metrics_inc('etf_api_request_errors_total', (('route', metrics_route()), ('code', str(body.get('code', '')))))
+        except:
+            pass
+
+    return response
+
+# after_request is skipped when a handler raises
+@app.teardown_request
+def metrics_teardown_request(exception):
+
+    if exception is not None and g.get('metrics_start') is not None and not g.get('metrics_recorded'):
+        metrics_request('500')
+
+@app.route('/metrics', methods=['GET'])
+@verify_admin
+def metrics():
+    return Response(metrics_render(), mimetype='text/plain; version=0.0.4')
+
+# Profiling
+# Stacks are sampled from a native thread, which keeps running while a greenlet holds the hub, and returned in the
+# collapsed format read by flamegraph tools. Greenlets share the main thread so a sample is the greenlet running at
+# the time. A single request can be profiled by sending the admin secret in an X-Profile header, in which case its
+# greenlet is sampled whether it's running or waiting and the stacks are kept under the request's trace ID
+profile_max_seconds = 60
+profile_default_interval = 10 # Milliseconds between samples
+profile_keep = 20 # Request profiles kept for retrieval
+profile_running = False
+profile_results = {}
+
+_profile_thread = monkey.get_original('_thread', 'start_new_thread')
+_profile_sleep = monkey.get_original('time', 'sleep')
+_profile_main = monkey.get_original('_thread', 'get_ident')()
+
+def _profile_stack(frame):
+
+    labels = []
+
+    while frame is not None:
+        code = frame.f_code
+        labels.append('%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+
+    return ';'.join(reversed(labels))
+
+def _profile_run(state, target, seconds, interval):
+
+    deadline = time.perf_counter() + seconds
+
+    try:
+        while not state['stop'] and time.perf_counter() < deadline:
+            if target is not None and target.dead:
+                break
+
+            # A greenlet has no frame of its own while it's the one running
+            frame = target.gr_frame if target is not None else None
+
+            if frame is None:
+                frame = sys._current_frames().get(_profile_main)
+
+            if frame is not None:
+                state['samples'][_profile_stack(frame)] += 1
+
+            _profile_sleep(interval)
+    finally:
+        state['done'] = True
+
+# Samples the main thread, or only the given greenlet, until the state is stopped or the time runs out
+def profile_start(target, seconds, interval):
+
+    state = {'samples': Counter(), 'interval': interval, 'stop': False, 'done': False}
+    _profile_thread(_profile_run, (state, target, seconds, interval))
+
+    return state
+
+def profile_collapse(state):
+    return ''.join('%s %s\n' % (stack, count) for stack, count in sorted(state['samples'].items()))
+
+@app.before_request
+def profile_before_request():
+
+    secret = request.headers.get('X-Profile')
+
+    if secret is not None and hmac.compare_digest(secret.encode('utf-8'), admin_secret.encode('utf-8')):
+        g.profile = profile_start(getcurrent(), profile_max_seconds, profile_default_interval / 1000)
+
+        profile_results[g.trace_id] = g.profile
+
+        while len(profile_results) > profile_keep:
+            del profile_results[next(iter(profile_results))]
+
+@app.teardown_request
+def profile_teardown_request(exception):
+
+    if g.get('profile') is not None:
+        g.profile['stop'] = True
+
+@app.route('/admin/profile', methods=['POST'])
+@verify_admin
+def admin_profile():
+    global profile_running
+
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', profile_default_interval))
+    except:
+        return jsonify({'error': "Parameters 'seconds' or 'interval' are invalid", 'code': 400})
+
+    if seconds <= 0 or seconds > profile_max_seconds:
+        return jsonify({'error': "Parameter 'seconds' must be between 0 and %s" % profile_max_seconds, 'code': 400})
+
+    if interval < 1 or interval > 1000:
+        return jsonify({'error': "Parameter 'interval' must be between 1 and 1000 milliseconds", 'code': 400})
+
+    if profile_running:
+        return jsonify({'error': "A profile is already running", 'code': 409})
+
+    profile_running = True
+
+    try:
+        state = profile_start(None, seconds, interval / 1000)
+
+        # Sleeping yields to the hub so the profiled requests keep being served
+        while not state['done']:
+            time.sleep(0.05)
+    finally:
+        profile_running = False
+
+    return Response(profile_collapse(state), mimetype='text/plain')
+
+@app.route('/admin/profile/<trace_id>', methods=['GET'])
+@verify_admin
+def admin_profile_request(trace_id):
+
+    state = profile_results.get(trace_id)
+
+    if state is None:
+        return jsonify({'error': "No profile was kept for this trace ID", 'code': 404})
+
+    if not state['done']:
+        return jsonify({'error': "The request is still being profiled", 'code': 409})
+
+    return Response(profile_collapse(state), mimetype='text/plain')
+
+# Memory
+# tracemalloc is only started on request since it slows down every allocation. Each snapshot is diffed against
+# the previous one to show which allocation sites grew in between
+memory_snapshot = None
+memory_default_frames = 1
+memory_skip_types = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+# Long lived structures and caches by name, looked up when measured since some are built on first use
+def memory_structures():
+    return [
+        ('blueprint_catalog', blueprint_catalog),
+        ('market_groups', market_groups),
+        ('market_id_to_volume', market_id_to_volume),
+        ('system_name_to_id', system_name_to_id),
+        ('sde_payloads', sde_payloads),
+        ('type_catalog', (type_catalog_ids, type_catalog_rows, market_group_bits)),
+        ('station_index', station_index),
+        ('usedin_index', usedin_index),
+        ('bom_graph', bom_graph),
+        ('bom_cache', bom_cache),
+        ('profit_matrix', profit_matrix),
+        ('profit_cache', profit_cache),
+        ('valuation_state', valuation_state),
+        ('depth_cache', depth_cache),
+        ('price_alerts', (price_alert_index, price_alert_state, price_alert_cooldown, price_alert_last)),
+        ('system_search_index', system_search_index),
+        ('system_search_cache', search_system_names),
+        ('item_search_index', item_search_index),
+        ('item_search_cache', search_item_rows),
+        ('backtest_series_cache', _backtest_series),
+        ('metrics', (metrics_counters, metrics_histograms)),
+        ('request_profiles', profile_results),
+        ('redis_connections', re.connection_pool if re is not None else None)
+    ]
+
+# Bytes of an object and everything it references that wasn't already counted in seen.
+# Memory mapped files are counted separately since their pages are shared between workers
+def memory_deep_size(obj, seen):
+
+    size = 0
+    mapped = 0
+    stack = [obj]
+
+    while stack:
+        obj = stack.pop()
+
+        if obj is None or id(obj) in seen or isinstance(obj, memory_skip_types):
+            continue
+
+        seen.add(id(obj))
+
+        if isinstance(obj, mmap.mmap):
+            mapped += len(obj)
+            continue
+
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, np.ndarray):
+            # Views only count their header, the data belongs to the base
+            stack.append(obj.base)
+        elif isinstance(obj, memoryview):
+            stack.append(obj.obj)
+        elif hasattr(obj, 'cache_info'):
+            # An lru_cache refers to the keys and results it holds
+            stack.extend(gc.get_referents(obj))
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+
+    return size, mapped
+
+def memory_rss():
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except:
+        return None
+
+def _memory_tracing():
+
+    current, peak = tracemalloc.get_traced_memory()
+
+    return {'tracing': tracemalloc.is_tracing(), 'traced': current, 'tracedPeak': peak}
+
+# Structures are measured in order and objects shared between them only count towards the first
+@app.route('/admin/memory', methods=['GET'])
+@verify_admin
+def admin_memory():
+
+    seen = set()
+    structures = []
+
+    for name, obj in memory_structures():
+        size, mapped = memory_deep_size(obj, seen)
+        structure = {'name': name, 'bytes': size, 'mapped': mapped}
+
+        if hasattr(obj, 'cache_info'):
+            structure['entries'] = obj.cache_info().currsize
 
-debug = False if env == 'production' else True
+        structures.append(structure)
 
-auth_jwt_secret = 'development' if debug else os.environ.get('ETF_API_JWT_SECRET', 'production')
+    structures.sort(key=lambda structure: structure['bytes'], reverse=True)
 
-# Use to connect to private backend publishing API
-admin_secret = os.environ.get('ETF_API_ADMIN_SECRET', 'admin_secret')
+    return jsonify(dict(_memory_tracing(), rss=memory_rss(), structures=structures))
 
-# Application
-app = Flask(__name__)
-app.wsgi_app = ProxyFix(app.wsgi_app)
-app.secret_key = os.environ.get('ETF_API_JWT_SECRET', 'production')
-CORS(app)
+# Starts tracing on the first call. Later calls take a snapshot and return the allocation sites that grew most
+# since the previous snapshot, grouped by 'lineno', 'filename' or 'traceback'
+@app.route('/admin/memory/snapshot', methods=['POST'])
+@verify_admin
+def admin_memory_snapshot():
+    global memory_snapshot
 
-# Single sign on service
-oauth = OAuth(app)
-evesso = oauth.remote_app('evesso',
-    consumer_key=os.environ.get('ETF_API_OAUTH_KEY', 'example'),
-    consumer_secret=os.environ.get('ETF_API_OAUTH_SECRET', 'example'),
-    request_token_params={
-        'scope': '',
-        'state': lambda: session['evesso_state']
-    },
-    base_url='https://login.eveonline.com/',
-    request_token_url=None,
-    access_token_method='POST',
-    access_token_url='https://login.eveonline.com/oauth/token',
-    authorize_url='https://login.eveonline.com/oauth/authorize'
-)
+    group = request.args.get('group', 'lineno')
 
-# Sentry exception tracking
-app.config['SENTRY_CONFIG'] = {
-    'ignore_exceptions': ['KeyboardInterrupt'],
-}
-sentry = Sentry(app, dsn='dsn' if env == 'production' else None)
+    try:
+        limit = int(request.args.get('limit', 25))
+        frames = int(request.args.get('frames', memory_default_frames))
+    except:
+        return jsonify({'error': "Parameters 'limit' or 'frames' are invalid", 'code': 400})
 
-# SDE
-market_ids = []
-system_name_to_id = {}
+    if group not in ('lineno', 'filename', 'traceback'):
+        return jsonify({'error': "Parameter 'group' must be one of lineno, filename or traceback", 'code': 400})
 
-with open('sde/blueprints.js', 'r', encoding='utf-8') as f:
-    read_data = f.read()
-    blueprints_json = read_data
-    blueprints = json.loads(read_data)
+    if limit <= 0 or limit > 500 or frames <= 0 or frames > 100:
+        return jsonify({'error': "Parameter 'limit' must be between 1 and 500 and 'frames' between 1 and 100", 'code': 400})
 
-with open('sde/market_groups.js', 'r', encoding='utf-8') as f:
-    read_data = f.read()
-    market_groups_json = read_data
-    market_groups = json.loads(read_data)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        memory_snapshot = None
 
-    _getItems = lambda items: [x['id'] for x in items]
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+    ])
 
-    def _getGroups(group, ids):
-        if 'items' in group:
-            ids.extend(_getItems(group['items']))
+    if memory_snapshot is None:
+        stats = [(stat, stat.size, stat.count) for stat in snapshot.statistics(group)]
+    else:
+        stats = [(stat, stat.size_diff, stat.count_diff) for stat in snapshot.compare_to(memory_snapshot, group)]
+
+    memory_snapshot = snapshot
+    sites = []
+
+    for stat, size_diff, count_diff in sorted(stats, key=lambda item: item[1], reverse=True)[:limit]:
+        sites.append({
+            'site': [str(frame) for frame in stat.traceback] if group == 'traceback' else str(stat.traceback[0]),
+            'bytes': stat.size,
+            'bytesDiff': size_diff,
+            'count': stat.count,
+            'countDiff': count_diff
+        })
 
-        for _group in group['childGroups']:
-            _getGroups(_group, ids)
+    return jsonify(dict(_memory_tracing(), rss=memory_rss(), sites=sites))
 
-    for group in market_groups:
-        _getGroups(group, market_ids)
+@app.route('/admin/memory/snapshot', methods=['DELETE'])
+@verify_admin
+def admin_memory_stop():
+    global memory_snapshot
 
-with open('sde/market_id_to_volume.json', 'r', encoding='utf-8') as f:
-    read_data = f.read()
-    market_id_to_volume_json = read_data
-    market_id_to_volume = dict({int(k):v for k,v in json.loads(market_id_to_volume_json).items()})
+    memory_snapshot = None
+    tracemalloc.stop()
 
-try:
-    res = requests.get('https://crest-tq.eveonline.com/industry/systems/', timeout=10, headers=standard_headers)
+    return jsonify(_memory_tracing())
 
-    doc = json.loads(res.text)
+# Hub blocking
+# A greenlet only gives the hub a chance to run other greenlets when it waits on I/O or sleeps, so CPU heavy code
+# stalls every other request on the worker. Greenlet switches are traced to know which greenlet is running and since
+# when, and a native thread reports any greenlet other than the hub that runs past ETF_API_HUB_BLOCK_MS (0 disables).
+# Blocks are logged once they end, with the stack captured while blocked, to the slow log if set or stderr otherwise
+hub_block_threshold = float(os.environ.get('ETF_API_HUB_BLOCK_MS', 100)) / 1000
+hub_state = {'current': None, 'since': 0}
+hub_requests = {} # Greenlet: (method, route, trace ID) of the request it's handling
+hub_monitor_running = False
 
-    for item in doc['items']:
-        system_name_to_id[item['solarSystem']['name']] = item['solarSystem']['id']
+def _hub_trace(event, args):
 
-except:
-    traceback.print_exc()
-    exit()
+    if event == 'switch' or event == 'throw':
+        hub_state['current'] = args[1]
+        hub_state['since'] = time.perf_counter()
 
-re = None
+def _hub_stack(frame):
 
-try:
-    re = redis.StrictRedis(host=redis_host, port=6379, db=0)
-except:
-    print("Redis server is unavailable")
-    sentry.captureException()
+    stack = []
 
-# Decorator to validate a JWT and retrieve the users info from rethinkDB
-# Authorization types:
-#   Token <jwt>
-#   Key <api_key>
-def verify_jwt(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
+    while frame is not None:
+        stack.append('%s:%s %s' % (os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
 
-        user_settings = None
+    return list(reversed(stack))
 
-        try:
-            auth_header = request.headers.get('Authorization')
+def _hub_report(block, seconds):
 
-            if auth_header == None:
-                auth_header = request.headers.get('authorization')
+    metrics_observe('etf_api_hub_blocked_seconds', (('route', block['route']),), seconds)
 
-            if auth_header == None:
-                return jsonify({ 'error': "Authorization header is missing", 'code': 400 })
+    entry = dict(block, time=datetime.utcnow().isoformat(), event='hub_blocked', durationMs=round(seconds * 1000, 3))
+    del entry['since']
 
-            split = auth_header.split(" ")
+    if trace_slow_log is not None:
+        trace_write(entry)
+    else:
+        print(json.dumps(entry), file=sys.stderr)
 
-            if len(split) != 2:
-                return jsonify({ 'error': "Invalid authorization header format", 'code': 400 })
+def _hub_monitor(hub, interval):
 
-            if split[0] != "Token" and split[0] != "Key":
-                return jsonify({ 'error': "Authorization header must include 'Token' or 'Key'", 'code': 400 })
+    block = None
 
-            if split[0] == "Token":
-                try:
-                    user_data = jwt.decode(split[1], auth_jwt_secret)
+    while True:
+        _profile_sleep(interval)
 
-                    user_settings = mongo_db.settings.find_one({'user_id': user_data['user_id']})
-                except jwt.exceptions.ExpiredSignatureError:
-                    return jsonify({'error': "Authorization token is expired", 'code': 400})
-                except jwt.exceptions.InvalidTokenError:
-                    return jsonify({'error': "Authorization token is invalid", 'code': 400})
-                except:
-                    return jsonify({'error': "Failed to parse authorization token", 'code': 400})
+        current = hub_state['current']
+        since = hub_state['since']
 
-            elif split[0] == "Key":
+        # The block ended with the switch that moved since
+        if block is not None and since != block['since']:
+            _hub_report(block, since - block['since'])
+            block = None
 
-                try:
-                    if split[1] is None or len(split[1]) == 0:
-                        return jsonify({'error': "Unable to verify your API key. Please check that it is valid and typed correctly", 'code': 400})
+        if block is None and current is not None and current is not hub and time.perf_counter() - since >= hub_block_threshold:
+            method, route, trace_id = hub_requests.get(current, (None, 'none', None))
 
-                    user_settings = mongo_db.settings.find_one({'api_key': split[1]})
+            block = {
+                'since': since,
+                'method': method,
+                'route': route,
+                'traceId': trace_id,
+                'stack': _hub_stack(sys._current_frames().get(_profile_main))
+            }
 
-                    if user_settings is None:
-                        return jsonify({'error': "Unable to verify your API key. Please check that it is valid and typed correctly", 'code': 400})
-                except:
-                    return jsonify({'error': "Failed to correctly parse api key. Please check that it is valid and typed correctly", 'code': 400})
-        except:
-            traceback.print_exc()
-            return jsonify({ 'error': "Failed to parse authorization header", 'code': 400 })
+# Called from the main thread before serving, tracing every switch costs a little on each one
+def hub_monitor_start():
+    global hub_monitor_running
 
-        if user_settings is None:
-            return jsonify({'error': "Failed to look up user information", 'code': 400})
+    if hub_block_threshold <= 0 or hub_monitor_running:
+        return
 
-        user_id = user_settings['user_id']
+    from greenlet import settrace
 
-        return fn(user_id=user_id, settings=user_settings, *args, **kwargs)
+    hub_monitor_running = True
+    settrace(_hub_trace)
+    _profile_thread(_hub_monitor, (get_hub(), max(hub_block_threshold / 4, 0.005)))
 
-    return wrapper
+@app.before_request
+def hub_before_request():
+
+    if hub_monitor_running:
+        hub_requests[getcurrent()] = (request.method, metrics_route(), g.trace_id)
+
+@app.teardown_request
+def hub_teardown_request(exception):
+
+    if hub_monitor_running:
+        hub_requests.pop(getcurrent(), None)
 
 # Routes
 @app.route('/', methods=['GET'])
@@ -228,9 +1431,14 @@ def forecast(user_id, settings):
         maxvolume = request.args.get('maxvolume')
         minprice = request.args.get('minprice')
         maxprice = request.args.get('maxprice')
+        group = request.args.get('group')
+        group = None if group is None else int(group)
     except:
         return jsonify({ 'error': "Invalid type used in query parameters", 'code': 400 })
 
+    if group is not None and group not in market_group_bits:
+        return jsonify({ 'error': "The given market group does not exist", 'code': 400 })
+
     if minspread == None and maxspread == None:
         return jsonify({ 'error': "At least one of minspread and maxspread must be provided", 'code': 400 })
 
@@ -285,7 +1493,7 @@ def forecast(user_id, settings):
     # Load data from redis cache by accessing all item id's for the given region
     pip = re.pipeline()
 
-    for k in market_ids:
+    for k in market_type_ids(group):
         pip.hmget('dly:%s-%s' % (k, region), ['type', 'spread_sma', 'volume_sma', 'buyPercentile', 'velocity'])
 
     docs = pip.execute()
@@ -313,6 +1521,70 @@ def regionToStationHub(region):
         10000030: 60004588
     }.get(region, 0)
 
+# Stations
+
+# Station names are loaded on first use into a sorted ID array and a single utf-8 string table
+station_index = None
+station_source = 'sde/station_id_to_name.js'
+station_lookup_limit = 1000
+
+def _load_station_index():
+
+    with open(station_source, 'r', encoding='utf-8') as f:
+        data = f.read()
+
+    # The source is a javascript object literal with unquoted integer keys rather than JSON
+    entries = sorted((int(k), json.loads('"%s"' % v)) for k, v in regex.findall(r'(\d+):"((?:[^"\\]|\\.)*)"', data))
+
+    index = {
+        'ids': array('i'),
+        'offsets': array('i', [0]),
+        'names': bytearray()
+    }
+
+    for stationID, name in entries:
+        index['ids'].append(stationID)
+        index['names'].extend(name.encode('utf-8'))
+        index['offsets'].append(len(index['names']))
+
+    index['names'] = bytes(index['names'])
+
+    return index
+
+# Returns None for unknown stations such as player owned citadels
+def station_name(stationID):
+    global station_index
+
+    if station_index is None:
+        station_index = _load_station_index()
+
+    i = bisect_left(station_index['ids'], stationID)
+
+    if i == len(station_index['ids']) or station_index['ids'][i] != stationID:
+        return None
+
+    return station_index['names'][station_index['offsets'][i]:station_index['offsets'][i + 1]].decode('utf-8')
+
+def expand_requested(name):
+    return name in request.args.get('expand', '').split(',')
+
+@app.route('/sde/stations', methods=['GET'])
+def sde_stations():
+
+    # Validation
+    try:
+        ids = [int(x) for x in request.args.get('ids', '').split(',') if len(x) > 0]
+    except:
+        return jsonify({ 'error': "Parameter 'ids' must be a comma separated list of station IDs", 'code': 400 })
+
+    if len(ids) == 0:
+        return jsonify({ 'error': "No station IDs were provided", 'code': 400 })
+
+    if len(ids) > station_lookup_limit:
+        return jsonify({ 'error': "At most %s stations can be looked up at once" % station_lookup_limit, 'code': 400 })
+
+    return jsonify({str(stationID): station_name(stationID) for stationID in ids})
+
 @app.route('/market/forecast/regional', methods=['GET'])
 @verify_jwt
 def forecast_region(user_id, settings):
@@ -345,11 +1617,12 @@ def forecast_region(user_id, settings):
 
     start_order_map = {} # buy orders
     end_order_map = {} # sell orders
+    expand_stations = expand_requested('station')
 
     start_hub = regionToStationHub(start_region)
     end_hub = regionToStationHub(end_region)
 
-    for order in mongo_db.orders.find({'region': start_region, 'buy': False}, projection={'_id': False, 'time': False, 'id': False, 'region': False}):
+    for order in mongo_db.orders.find(region_orders_query(start_region, False), projection={'_id': False, 'time': False, 'id': False, 'region': False}):
 
         if order['stationID'] != start_hub and order['stationID'] < 1000000000000:
             continue
@@ -359,7 +1632,7 @@ def forecast_region(user_id, settings):
         else:
             start_order_map[order['type']] = [order]
 
-    for order in mongo_db.orders.find({'region': end_region, 'buy': True}, projection={'_id': False, 'time': False, 'id': False, 'region': False}):
+    for order in mongo_db.orders.find(region_orders_query(end_region, True), projection={'_id': False, 'time': False, 'id': False, 'region': False}):
 
         if order['stationID'] != end_hub and order['stationID'] < 1000000000000:
             continue
@@ -443,7 +1716,7 @@ def forecast_region(user_id, settings):
             if count <= 0:
                 break
 
-            trades.append({
+            trade = {
                 'totalProfit': (end[end_index]['price'] - start[start_index]['price']) * count,
                 'perProfit': end[end_index]['price'] - start[start_index]['price'],
                 'perVolumeProfit': (end[end_index]['price'] - start[start_index]['price']) / needed_volume,
@@ -452,7 +1725,15 @@ def forecast_region(user_id, settings):
                 'type': _type,
                 'buyPrice': start[start_index]['price'],
                 'sellPrice': end[end_index]['price'],
-            })
+            }
+
+            if expand_stations:
+                trade['buyStationID'] = start[start_index]['stationID']
+                trade['buyStation'] = station_name(start[start_index]['stationID'])
+                trade['sellStationID'] = end[end_index]['stationID']
+                trade['sellStation'] = station_name(end[end_index]['stationID'])
+
+            trades.append(trade)
 
             if end_volume <= 0:
 
@@ -492,6 +1773,114 @@ def market_current(region, typeid, user_id, settings):
 
     return jsonify({key.decode('ascii'):float(reDoc[key]) for key in (b'type', b'spread', b'tradeVolume', b'buyPercentile', b'sellPercentile')})
 
+# Order book depth
+
+# Ladders are cached per region, type and hub filter along with a digest of the order ID list they were built from.
+# Within depth_cache_ttl the cached ladder is served as is, after that it's only rebuilt if the order IDs changed
+depth_cache = {}
+depth_cache_ttl = 15
+depth_cache_version_ttl = 120
+depth_cache_size = 2048
+
+def _build_depth(region, typeid, hub, order_ids):
+
+    pip = re.pipeline()
+
+    for k in order_ids:
+        pip.hmget('ord:%s' % k.decode('ascii'), ['volume', 'buy', 'price', 'stationID'])
+
+    sides = {'buy': {}, 'sell': {}}
+    hub_station = regionToStationHub(region)
+
+    for row in pip.execute():
+
+        if row[0] == None or row[1] == None or row[2] == None or row[3] == None:
+            continue
+
+        if hub and int(row[3]) != hub_station:
+            continue
+
+        level = sides['buy' if row[1] == b'True' else 'sell'].setdefault(float(row[2]), [0, 0])
+        level[0] += float(row[0])
+        level[1] += 1
+
+    result = {
+        'region': region,
+        'typeID': typeid,
+        'hub': hub
+    }
+
+    for side, reverse in (('buy', True), ('sell', False)):
+        result[side] = [{'price': price, 'volume': level[0], 'orders': level[1]} for price, level in sorted(sides[side].items(), reverse=reverse)]
+        result[side + 'Volume'] = sum(level[0] for level in sides[side].values())
+        result[side + 'Orders'] = sum(level[1] for level in sides[side].values())
+
+    return result
+
+def market_depth_ladder(region, typeid, hub):
+
+    key = (region, typeid, hub)
+    now = time.time()
+    cached = depth_cache.get(key)
+
+    if cached is not None and now - cached['time'] < depth_cache_ttl:
+        return cached['result']
+
+    order_ids = re.lrange('ord_cnt:%s-%s' % (typeid, region), 0, -1)
+    version = hashlib.sha1(b','.join(order_ids)).hexdigest()
+
+    # Volumes of unchanged orders can still move, so even an unchanged order list is rebuilt eventually
+    if cached is not None and cached['version'] == version and now - cached['built'] < depth_cache_version_ttl:
+        cached['time'] = now
+        return cached['result']
+
+    result = _build_depth(region, typeid, hub, order_ids)
+
+    depth_cache.pop(key, None)
+
+    if len(depth_cache) >= depth_cache_size:
+        del depth_cache[next(iter(depth_cache))]
+
+    depth_cache[key] = {'time': now, 'built': now, 'version': version, 'result': result}
+
+    return result
+
+@app.route('/market/depth/<int:region>/<int:typeid>', methods=['GET'])
+@verify_jwt
+def market_depth(region, typeid, user_id, settings):
+
+    if settings.get('api_access', False) == False:
+        return jsonify({'error': "Active API access subscription is required to access this endpoint", 'code': 405})
+
+    # Validation
+    try:
+        hub = request.args.get('hub', 'false') == 'true'
+        levels = int(request.args.get('levels', 50))
+    except:
+        return jsonify({ 'error': "Invalid query parameters or missing parameter", 'code': 400 })
+
+    if region not in supported_regions:
+        return jsonify({ 'error': "The provided region %s is not supported" % region, 'code': 400 })
+
+    if not is_market_type(typeid):
+        return jsonify({ 'error': "Required parameter 'typeID' is not a market item", 'code': 400 })
+
+    if levels <= 0 or levels > 1000:
+        return jsonify({ 'error': "Parameter 'levels' must be between 1 and 1000", 'code': 400 })
+
+    try:
+        ladder = market_depth_ladder(region, typeid, hub)
+    except:
+        traceback.print_exc()
+        return jsonify({ 'error': "There was a problem loading the order book", 'code': 400 })
+
+    result = dict(ladder)
+
+    for side in ('buy', 'sell'):
+        result[side] = ladder[side][:levels]
+
+    return jsonify(result)
+
 @app.route('/market/history/minutes/<int:typeid>', methods=['GET'])
 @verify_jwt
 def market_history_minutes(typeid, user_id, settings):
@@ -502,7 +1891,7 @@ def market_history_minutes(typeid, user_id, settings):
     if isinstance(typeid, int) == False:
         return jsonify({ 'error': "Required parameter 'typeID' is not a valid integer", 'code': 400 })
 
-    data = list(aggregates_minutes.find({'type': typeid}, fields={'_id': False}))
+    data = list(aggregates_minutes.find(history_query(typeid), fields={'_id': False}))
 
     for d in data:
         d['time'] = d['time'].isoformat()
@@ -519,7 +1908,7 @@ def market_history_hourly(typeid, user_id, settings):
     if isinstance(typeid, int) == False:
         return jsonify({ 'error': "Required parameter 'typeID' is not a valid integer", 'code': 400 })
 
-    data = list(aggregates_hourly.find({'type': typeid}, fields={'_id': False}))
+    data = list(aggregates_hourly.find(history_query(typeid), fields={'_id': False}))
 
     for d in data:
         d['time'] = d['time'].isoformat()
@@ -536,13 +1925,45 @@ def market_history_daily(typeid, user_id, settings):
     if isinstance(typeid, int) == False:
         return jsonify({ 'error': "Required parameter 'typeID' is not a valid integer", 'code': 400 })
 
-    data = list(aggregates_daily.find({'type': typeid}, fields={'_id': False}))
+    data = list(aggregates_daily.find(history_query(typeid), fields={'_id': False}))
 
     for d in data:
         d['time'] = d['time'].isoformat()
 
     return jsonify(data)
 
+# Values on user orders are stored as the strings returned by the EVE API, so filters match either form
+def _order_value_filter(value):
+    return {'$in': [value, str(value)]}
+
+# Totals of the open orders matching a query, overall and per type. A query of None matches no orders
+def market_orders_summary(query):
+
+    summary = {'orders': 0, 'buyOrders': 0, 'sellOrders': 0, 'buyValue': 0, 'sellValue': 0, 'escrow': 0}
+    types = {}
+    orders = [] if query is None else user_orders_collection.find(dict(query, orderState=_order_value_filter(0)), fields={'_id': False, 'typeID': True, 'bid': True, 'price': True, 'volRemaining': True, 'escrow': True})
+
+    for order in orders:
+        value = float(order['price']) * int(order['volRemaining'])
+        side = 'buy' if str(order['bid']) == '1' else 'sell'
+        typeID = int(order['typeID'])
+
+        if typeID not in types:
+            types[typeID] = {'typeID': typeID, 'buyOrders': 0, 'sellOrders': 0, 'buyValue': 0, 'sellValue': 0}
+
+        for doc in (summary, types[typeID]):
+            doc[side + 'Orders'] += 1
+            doc[side + 'Value'] += value
+
+        summary['orders'] += 1
+
+        if side == 'buy':
+            summary['escrow'] += float(order.get('escrow', 0) or 0)
+
+    summary['types'] = sorted(types.values(), key=lambda doc: doc['buyValue'] + doc['sellValue'], reverse=True)
+
+    return summary
+
 @app.route('/market/orders/self', methods=['GET'])
 @verify_jwt
 def market_self_orders(user_id, settings):
@@ -550,18 +1971,261 @@ def market_self_orders(user_id, settings):
     if settings.get('api_access', False) == False:
         return jsonify({'error': "Active API access subscription is required to access this endpoint", 'code': 405})
 
+    query = user_query(user_id)
+
+    # Validation
     try:
-        orders = list(user_orders_collection.find({'user_id': user_id}, fields={'_id': False}))
+        profile = request.args.get('profile', None)
+        side = request.args.get('side', None)
+        typeid = request.args.get('typeid', None)
+        station = request.args.get('station', None)
+        region = request.args.get('region', None)
+        summary = request.args.get('summary', 'false') == 'true'
+
+        if profile is not None:
+            query['whoID'] = int(profile)
+        if typeid is not None:
+            query['typeID'] = _order_value_filter(int(typeid))
+        if station is not None:
+            query['stationID'] = _order_value_filter(int(station))
+        if region is not None:
+            region = int(region)
+    except:
+        return jsonify({ 'error': "Invalid query parameters or missing parameter", 'code': 400 })
 
-        if orders is None or len(orders) == 0:
-            raise Exception()
+    if side is not None:
+        if side not in ('buy', 'sell'):
+            return jsonify({ 'error': "Parameter 'side' must be either 'buy' or 'sell'", 'code': 400 })
+
+        query['bid'] = {'$in': ['1', 1, True]} if side == 'buy' else {'$in': ['0', 0, False]}
+
+    # Orders don't carry a region so a region only matches its trade hub
+    # A station outside of it can't match anything, which is answered in the requested shape without a query
+    if region is not None:
+        if region not in supported_regions:
+            return jsonify({ 'error': "The provided region %s is not supported" % region, 'code': 400 })
+        if station is not None and int(station) != regionToStationHub(region):
+            query = None
+        else:
+            query['stationID'] = _order_value_filter(regionToStationHub(region))
 
+    if summary:
+        try:
+            return jsonify(market_orders_summary(query))
+        except Exception:
+            traceback.print_exc()
+            return jsonify({ 'error': "There was a database error while summarizing your orders", 'code': 400 })
+
+    paged = 'cursor' in request.args or 'limit' in request.args
+    next_cursor = None
+
+    try:
+        if paged:
+            cursor, limit = parse_page_args(100, 1000)
+
+            orders, next_cursor = ([], None) if query is None else paginate(user_orders_collection, query, cursor, limit)
+
+            for order in orders:
+                del order['_id']
+        else:
+            orders = [] if query is None else list(user_orders_collection.find(query, fields={'_id': False}))
+
+    except ValueError as e:
+        return jsonify({ 'error': str(e), 'code': 400 })
     except Exception:
         traceback.print_exc()
+
+        if paged:
+            return jsonify({ 'error': "There was a database error while loading your orders", 'code': 400 })
+
         return jsonify([])
 
+    if expand_requested('station'):
+        for order in orders:
+            order['stationName'] = station_name(int(order['stationID']))
+
+    if paged:
+        return jsonify({
+            'orders': orders,
+            'next': next_cursor
+        })
+
     return jsonify(orders)
 
+# Portfolio valuation
+
+# Live portfolio values are kept per supported region along with a reverse index from typeID to the portfolios using
+# it. Prices are reloaded once per price generation, the time of the newest 5 minute aggregate, and only the
+# portfolios referencing a changed type are revalued. Values are always summed from scratch so they can't drift
+valuation_limit = 10000 # portfolios tracked per region, the least recently served are dropped first
+valuation_state = {}
+
+def _valuation_region(region):
+
+    if region not in valuation_state:
+        valuation_state[region] = {
+            'generation': None,
+            'prices': {}, # typeID -> {'sell': price, 'buy': price}
+            'terms': {}, # portfolioID -> list of (typeID, field, side, weight)
+            'base': {}, # portfolioID -> value fields that don't depend on the market
+            'index': {}, # typeID -> set of portfolioIDs
+            'values': OrderedDict() # portfolioID -> live value fields, least recently served first
+        }
+
+    return valuation_state[region]
+
+# Each term adds weight * price of the type to one of the value fields of the portfolio
+def _valuation_terms(portfolio):
+
+    terms = []
+
+    if portfolio.get('type', 0) == 0:
+        for component in portfolio.get('components', []):
+            terms.append((component['typeID'], 'currentValue', 'sell', component['quantity']))
+            terms.append((component['typeID'], 'currentBuyValue', 'buy', component['quantity']))
+    else:
+        for component in portfolio.get('components', []):
+            terms.append((component['typeID'], 'industryValue', 'sell', component['quantity']))
+
+        # An override sell price is fixed and doesn't depend on the market
+        if portfolio.get('overrideSellPrice', 0) == 0:
+            terms.append((portfolio['industryTypeID'], 'currentValue', 'sell', portfolio.get('manufacturedQuantity', 0)))
+
+    return terms
+
+def _valuation_base(portfolio):
+
+    base = {'currentValue': 0, 'currentBuyValue': 0, 'industryValue': 0}
+
+    if portfolio.get('type', 0) == 1 and portfolio.get('overrideSellPrice', 0) != 0:
+        base['currentValue'] = portfolio['overrideSellPrice'] * portfolio.get('manufacturedQuantity', 0)
+
+    return base
+
+def _valuation_compute(state, portfolioID):
+
+    values = dict(state['base'][portfolioID])
+
+    for typeID, field, side, weight in state['terms'][portfolioID]:
+        values[field] += weight * state['prices'].get(typeID, {}).get(side, 0)
+
+    return values
+
+def _valuation_fetch(region, type_ids):
+
+    pip = re.pipeline()
+
+    for typeID in type_ids:
+        pip.hmget('cur:%s-%s' % (typeID, region), ['sellPercentile', 'buyPercentile'])
+
+    return {typeID: {'sell': 0 if row[0] is None else float(row[0]), 'buy': 0 if row[1] is None else float(row[1])} for typeID, row in zip(type_ids, pip.execute())}
+
+# Time of the newest 5 minute aggregate, which changes with every price update
+def valuation_generation():
+
+    doc = aggregates_minutes.find_one({}, projection={'_id': False, 'time': True}, sort=latest_aggregate_sort)
+
+    return None if doc is None else doc['time']
+
+# Applies new prices and revalues only the portfolios that reference a changed type
+def valuation_apply_prices(region, prices):
+
+    state = _valuation_region(region)
+    changed = set()
+
+    for typeID, price in prices.items():
+
+        if state['prices'].get(typeID) == price:
+            continue
+
+        state['prices'][typeID] = price
+        changed.update(state['index'].get(typeID, ()))
+
+    for portfolioID in changed:
+        state['values'][portfolioID] = _valuation_compute(state, portfolioID)
+
+def valuation_refresh(region, generation):
+
+    state = _valuation_region(region)
+
+    if state['generation'] == generation:
+        return
+
+    state['generation'] = generation
+
+    valuation_apply_prices(region, _valuation_fetch(region, list(state['index'].keys())))
+
+def valuation_track(region, portfolio):
+
+    state = _valuation_region(region)
+    portfolioID = portfolio['portfolioID']
+    terms = _valuation_terms(portfolio)
+    base = _valuation_base(portfolio)
+
+    if state['terms'].get(portfolioID) == terms and state['base'].get(portfolioID) == base:
+        state['values'].move_to_end(portfolioID)
+        return
+
+    valuation_untrack(portfolioID)
+
+    missing = [typeID for typeID, _, _, _ in terms if typeID not in state['prices']]
+
+    if len(missing) > 0:
+        state['prices'].update(_valuation_fetch(region, list(set(missing))))
+
+    state['terms'][portfolioID] = terms
+    state['base'][portfolioID] = base
+    state['values'][portfolioID] = _valuation_compute(state, portfolioID)
+
+    for typeID, _, _, _ in terms:
+        state['index'].setdefault(typeID, set()).add(portfolioID)
+
+    while len(state['values']) > valuation_limit:
+        _valuation_drop(state, next(iter(state['values'])))
+
+def _valuation_drop(state, portfolioID):
+
+    terms = state['terms'].pop(portfolioID, None)
+    state['base'].pop(portfolioID, None)
+    state['values'].pop(portfolioID, None)
+
+    if terms is None:
+        return
+
+    for typeID, _, _, _ in terms:
+        portfolios = state['index'].get(typeID)
+
+        if portfolios is not None:
+            portfolios.discard(portfolioID)
+
+            # Prices are only kept for types that a tracked portfolio still references
+            if len(portfolios) == 0:
+                del state['index'][typeID]
+                state['prices'].pop(typeID, None)
+
+def valuation_untrack(portfolioID):
+
+    for state in valuation_state.values():
+        _valuation_drop(state, portfolioID)
+
+# Overwrites the stored value fields of the given portfolios with live values
+def valuation_apply(portfolios, settings):
+
+    region = settings.get('market', {}).get('region', 10000002)
+
+    if region not in supported_regions:
+        return
+
+    try:
+        valuation_refresh(region, valuation_generation())
+
+        for portfolio in portfolios:
+            valuation_track(region, portfolio)
+            portfolio.update(valuation_state[region]['values'][portfolio['portfolioID']])
+    except:
+        # Stored values are still valid to return if live prices can't be loaded
+        traceback.print_exc()
+
 @app.route('/portfolio/create', methods=['POST'])
 @verify_jwt
 def create_portfolio(user_id, settings):
@@ -671,7 +2335,7 @@ def create_portfolio(user_id, settings):
 
             # Trading components will use the user supplied components and not duplicates
             if _type == 0:
-                if str(typeID) not in market_ids:
+                if not is_market_type(typeID):
                     return jsonify({ 'error': "Component 'typeID' is not a valid market item", 'code': 400 })
 
                 used_ids.append(typeID)
@@ -679,28 +2343,26 @@ def create_portfolio(user_id, settings):
 
             # Industry components are auto-selected based on the manufactured component the user requested
             else:
-                if str(typeID) not in blueprints:
+                if not is_blueprint(typeID):
                     return jsonify({ 'error': "Component 'typeID' is not a valid manufacturable item", 'code': 400 })
 
-                _blueprint = blueprints[str(typeID)]
-
                 # Multiply the component requirements by the number of runs
                 # Also consider the material efficiency
-                for comp in _blueprint['materials']:
-                    _components.append({'typeID': comp['typeID'], 'quantity':    math.ceil(comp['quantity'] * quantity * ((100.0 - efficiency) / 100.0))})
+                for compTypeID, compQuantity in blueprint_materials(typeID):
+                    _components.append({'typeID': compTypeID, 'quantity':    max(quantity, math.ceil(compQuantity * quantity * ((100.0 - efficiency) / 100.0)))})
 
                 industryQuantity = quantity
                 industryTypeID = typeID
 
                 # Multiply the manufactured quantity by the quantiy of the component the user is tracking
                 # So if its 5 missile blueprints that each manufacture 100, the total quantiy is 500
-                manufacturedQuantity = _blueprint['quantity'] * quantity
+                manufacturedQuantity = blueprint_quantity(typeID) * quantity
 
     except:
         traceback.print_exc()
         return jsonify({ 'error': "There is an error in the components array or the component is invalid", 'code': 400 })
 
-    userPortfolioCount = portfolio_collection.find({'user_id': user_id}).count()
+    userPortfolioCount = portfolio_collection.find(user_query(user_id)).count()
 
     if userPortfolioCount >= portfolio_limit:
         return jsonify({ 'error': "There is a limit of %s portfolios that a user can create. If you need this limit raised, contact an EVE Exchange admin." % portfolio_limit, 'code': 400 })
@@ -708,7 +2370,7 @@ def create_portfolio(user_id, settings):
     try:
         portfolioCount = portfolio_collection.find().count()
         if portfolioCount > 0:
-            portfolioMax = list(portfolio_collection.find().sort('portfolioID', DESCENDING))[0]
+            portfolioMax = list(portfolio_collection.find().sort(next_portfolio_sort))[0]
             portfolioID = 1 if portfolioMax is None else portfolioMax['portfolioID'] + 1
         else:
             portfolioID = 1
@@ -763,7 +2425,7 @@ def portfolio_delete(id, user_id, settings):
         return jsonify({'error': "A Premium subscription is required to access this endpoint", 'code': 405})
 
     try:
-        portfolio = portfolio_collection.find_one({'user_id': user_id, 'portfolioID': id})
+        portfolio = portfolio_collection.find_one(portfolio_query(user_id, id))
 
         if portfolio is None:
             raise Exception()
@@ -772,7 +2434,11 @@ def portfolio_delete(id, user_id, settings):
         return jsonify({ 'error': "Failed to look up your portfolio. Double check that you have the correct portfolio ID", 'code': 400 })
 
     try:
-        portfolio_collection.remove({'user_id': user_id, 'portfolioID': id}, multi=False)
+        portfolio_collection.remove(portfolio_query(user_id, id), multi=False)
+
+        portfolio_charts_collection.remove({'portfolioID': id})
+
+        valuation_untrack(id)
 
         requests.post('http://localhost:4501/publish/portfolios/%s' % user_id, timeout=1)
 
@@ -800,7 +2466,7 @@ def portfolio_get_single(id, user_id, settings):
         return jsonify({'error': "Active API access subscription is required to access this endpoint", 'code': 405})
 
     try:
-        portfolio = portfolio_collection.find_one({'user_id': user_id, 'portfolioID': id}, fields={'_id': False, 'hourlyChart': False, 'dailyChart': False})
+        portfolio = portfolio_collection.find_one(portfolio_query(user_id, id), fields={'_id': False, 'hourlyChart': False, 'dailyChart': False})
 
         if portfolio is None:
             raise Exception()
@@ -808,6 +2474,8 @@ def portfolio_get_single(id, user_id, settings):
     except:
         return jsonify({ 'error': "Failed to look up your portfolio. Double check that you have the correct portfolio ID and that you have permissions for it", 'code': 400 })
 
+    valuation_apply([portfolio], settings)
+
     portfolio['time'] = portfolio.get('time', datetime.utcnow()).isoformat()
 
     return jsonify(portfolio)
@@ -820,7 +2488,7 @@ def portfolio_get_all(user_id, settings):
         return jsonify({'error': "Active API access subscription is required to access this endpoint", 'code': 405})
 
     try:
-        portfolios = list(portfolio_collection.find({'user_id': user_id}, fields={'_id': False, 'hourlyChart': False, 'dailyChart': False}))
+        portfolios = list(portfolio_collection.find(user_query(user_id), fields={'_id': False, 'hourlyChart': False, 'dailyChart': False}))
 
         if portfolios is None or len(portfolios) == 0:
             raise Exception()
@@ -828,6 +2496,8 @@ def portfolio_get_all(user_id, settings):
     except:
         return jsonify({ 'error': "Failed to look up your portfolios. Double check that you've created at least one portfolio", 'code': 400 })
 
+    valuation_apply(portfolios, settings)
+
     for p in portfolios:
         p['time'] = p.get('time', datetime.utcnow()).isoformat()
 
@@ -838,7 +2508,7 @@ def portfolio_get_all(user_id, settings):
 def portfolio_get_multibuy(id, user_id, settings):
 
     try:
-        portfolio = portfolio_collection.find_one({'user_id': user_id, 'portfolioID': id}, projection={'_id': False, 'hourlyChart': False, 'dailyChart': False})
+        portfolio = portfolio_collection.find_one(portfolio_query(user_id, id), projection={'_id': False, 'hourlyChart': False, 'dailyChart': False})
 
         if portfolio is None:
             raise Exception()
@@ -893,43 +2563,620 @@ def portfolio_get_multibuy(id, user_id, settings):
             'price': float(row[2])
         })
 
-    for _type in type_to_component:
+    for _type in type_to_component:
+
+        cost = 0
+        orders = sorted(type_to_order_map[_type], key=lambda doc: doc['price']) if _type in type_to_order_map else []
+        volume_required = type_to_component[_type]['quantity'] * quantity
+        available = 0
+        type_to_result[_type] = {
+            'price': 0,
+            'defecit': 0,
+            'wanted': volume_required,
+            'available': 0
+        }
+
+        for order in orders:
+
+            available += order['volume']
+
+            if volume_required == 0:
+                continue
+
+            if order['volume'] > volume_required:
+                cost += order['price'] * volume_required
+                volume_required = 0
+            else:
+                volume_required -= order['volume']
+                cost += order['price'] * order['volume']
+
+        if volume_required > 0:
+            type_to_result[_type]['defecit'] = volume_required
+
+        type_to_result[_type]['price'] = cost
+        type_to_result[_type]['available'] = available
+        total_cost += cost
+
+    return jsonify({
+        'components': type_to_result,
+        'totalCost': total_cost
+    })
+
+# Portfolio charts
+
+# Chart points live in the portfolio_charts collection instead of the portfolio document
+# Points are bucketed per day for the hourly chart and per month for the daily chart so bucket documents stay small.
+# The backend adds points through /admin/portfolios/chart. Points it still appends to the embedded hourlyChart and
+# dailyChart arrays are served along with the buckets until they're moved over by migrate_portfolio_charts
+portfolio_chart_frequencies = ('hourly', 'daily')
+portfolio_chart_max_points = 1000
+
+def portfolio_chart_bucket(frequency, time):
+
+    if frequency == 'hourly':
+        return datetime(time.year, time.month, time.day)
+
+    return datetime(time.year, time.month, 1)
+
+def portfolio_chart_append(portfolioID, frequency, points):
+
+    buckets = {}
+
+    for point in points:
+        buckets.setdefault(portfolio_chart_bucket(frequency, point['time']), []).append(point)
+
+    for bucket, bucket_points in buckets.items():
+        portfolio_charts_collection.update({'portfolioID': portfolioID, 'frequency': frequency, 'bucket': bucket}, {
+            '$push': {
+                'points': {
+                    '$each': bucket_points
+                }
+            },
+            '$inc': {
+                'count': len(bucket_points)
+            }
+        }, upsert=True)
+
+# Moves any points embedded in portfolio documents into the chart buckets
+# Only the moved points are pulled, so points the backend appends in the meantime are kept for the next run
+def migrate_portfolio_charts():
+
+    migrated = 0
+
+    ensure_indexes('portfolio_charts')
+
+    for portfolio in portfolio_collection.find({'$or': [{'hourlyChart.0': {'$exists': True}}, {'dailyChart.0': {'$exists': True}}]}, projection={'portfolioID': True, 'hourlyChart': True, 'dailyChart': True}):
+
+        pulled = {}
+
+        for frequency in portfolio_chart_frequencies:
+            points = portfolio.get(frequency + 'Chart', [])
+
+            if len(points) > 0:
+                portfolio_chart_append(portfolio['portfolioID'], frequency, points)
+                pulled[frequency + 'Chart'] = {'time': {'$lte': max(point['time'] for point in points)}}
+
+        portfolio_collection.update({'_id': portfolio['_id']}, {'$pull': pulled})
+
+        migrated += 1
+
+    return migrated
+
+# Chart points sent by the backend as {frequency, points: [{portfolioID, time, ...values}]}
+@app.route('/admin/portfolios/chart', methods=['POST'])
+@verify_admin
+def admin_portfolio_chart():
+
+    try:
+        body = request.get_json(force=True)
+        frequency = body['frequency']
+        portfolios = {}
+
+        for point in body['points']:
+            point = dict(point)
+            portfolioID = int(point.pop('portfolioID'))
+            point['time'] = parse_time_arg(point['time'])
+
+            portfolios.setdefault(portfolioID, []).append(point)
+    except:
+        return jsonify({'error': "Chart points must be sent as {frequency, points: [{portfolioID, time, ...}]}", 'code': 400})
+
+    if frequency not in portfolio_chart_frequencies:
+        return jsonify({'error': "Parameter 'frequency' must be either 'hourly' or 'daily'", 'code': 400})
+
+    try:
+        for portfolioID, points in portfolios.items():
+            portfolio_chart_append(portfolioID, frequency, points)
+    except:
+        traceback.print_exc()
+        return jsonify({'error': "Failed to store chart points", 'code': 500})
+
+    return jsonify({'portfolios': len(portfolios), 'points': sum(len(points) for points in portfolios.values())})
+
+# Averages numeric fields over evenly sized groups of points, keeping the time of the first point in each group
+def downsample_points(points, count):
+
+    if len(points) <= count:
+        return points
+
+    size = len(points) / count
+    sampled = []
+
+    for i in range(count):
+
+        group = points[int(i * size):int((i + 1) * size)]
+        point = {'time': group[0]['time']}
+
+        for k, v in group[0].items():
+            if k != 'time' and isinstance(v, (int, float)):
+                point[k] = sum(p.get(k, 0) for p in group) / len(group)
+
+        sampled.append(point)
+
+    return sampled
+
+def parse_time_arg(value):
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    raise ValueError("Invalid time format %s" % value)
+
+@app.route('/portfolio/get/<int:id>/chart', methods=['GET'])
+@verify_jwt
+def portfolio_get_chart(id, user_id, settings):
+
+    if settings.get('api_access', False) == False:
+        return jsonify({'error': "Active API access subscription is required to access this endpoint", 'code': 405})
+
+    # Validation
+    try:
+        frequency = request.args.get('frequency', 'hourly')
+        start = request.args.get('start', None)
+        end = request.args.get('end', None)
+        count = int(request.args.get('points', portfolio_chart_max_points))
+
+        start = datetime.utcnow() - timedelta(days=7 if frequency == 'hourly' else 365) if start is None else parse_time_arg(start)
+        end = datetime.utcnow() if end is None else parse_time_arg(end)
+    except:
+        return jsonify({ 'error': "Invalid query parameters or missing parameter", 'code': 400 })
+
+    if frequency not in portfolio_chart_frequencies:
+        return jsonify({ 'error': "Parameter 'frequency' must be either 'hourly' or 'daily'", 'code': 400 })
+
+    if count <= 0 or count > portfolio_chart_max_points:
+        return jsonify({ 'error': "Parameter 'points' must be between 1 and %s" % portfolio_chart_max_points, 'code': 400 })
+
+    if start > end:
+        return jsonify({ 'error': "The start time must be before the end time", 'code': 400 })
+
+    try:
+        portfolio = portfolio_collection.find_one(portfolio_query(user_id, id), projection={'_id': False, 'portfolioID': True, frequency + 'Chart': True})
+
+        if portfolio is None:
+            raise Exception()
+
+    except:
+        return jsonify({ 'error': "Failed to look up your portfolio. Double check that you have the correct portfolio ID and that you have permissions for it", 'code': 400 })
+
+    # Bucketed points win over embedded points at the same time
+    points = {point['time']: point for point in portfolio.get(frequency + 'Chart', []) if start <= point['time'] <= end}
+
+    for bucket in portfolio_charts_collection.find(portfolio_chart_query(id, frequency, portfolio_chart_bucket(frequency, start), end), projection={'_id': False, 'points': True}).sort(portfolio_chart_sort):
+        points.update((point['time'], point) for point in bucket['points'] if start <= point['time'] <= end)
+
+    points = [points[time] for time in sorted(points)]
+
+    points = downsample_points(points, count)
+
+    for point in points:
+        point['time'] = point['time'].isoformat()
+
+    return jsonify(points)
+
+# Industry
+
+# Bill of materials DAG built over the blueprints SDE
+# Maps a product typeID to a list of (typeID, quantity, manufacturable) for each of its materials
+# Materials that would close a cycle (some blueprints list themselves) are treated as raw
+bom_graph = None
+
+# Memoized per unit material vectors keyed by (typeID, efficiency)
+bom_cache = {}
+
+def _build_bom_graph():
+
+    graph = {}
+    visiting = set()
+
+    for root in blueprint_products():
+
+        if root in graph:
+            continue
+
+        graph[root] = []
+        visiting.add(root)
+        stack = [(root, iter(blueprint_materials(root)))]
+
+        # Iterative depth first walk so back edges can be detected without recursion
+        while len(stack) > 0:
+            node, materials = stack[-1]
+            material = next(materials, None)
+
+            if material is None:
+                visiting.discard(node)
+                stack.pop()
+                continue
+
+            typeID, quantity = material
+            manufacturable = is_blueprint(typeID) and len(blueprint_materials(typeID)) > 0 and typeID not in visiting
+
+            graph[node].append((typeID, quantity, manufacturable))
+
+            if manufacturable and typeID not in graph:
+                graph[typeID] = []
+                visiting.add(typeID)
+                stack.append((typeID, iter(blueprint_materials(typeID))))
+
+    return graph
+
+# Returns the raw and intermediate material vectors required to manufacture a single unit of typeID
+# Material efficiency is applied at every level of the tree
+def bom_unit_vectors(typeID, efficiency=0):
+    global bom_graph
+
+    key = (typeID, efficiency)
+
+    if key in bom_cache:
+        return bom_cache[key]
+
+    if bom_graph is None:
+        bom_graph = _build_bom_graph()
+
+    raw = {}
+    intermediate = {}
+    scale = (100.0 - efficiency) / 100.0 / blueprint_quantity(typeID)
+
+    for materialID, quantity, manufacturable in bom_graph.get(typeID, []):
+
+        amount = quantity * scale
+
+        if manufacturable:
+            intermediate[materialID] = intermediate.get(materialID, 0) + amount
+
+            sub_raw, sub_intermediate = bom_unit_vectors(materialID, efficiency)
+
+            for k, v in sub_raw.items():
+                raw[k] = raw.get(k, 0) + amount * v
+
+            for k, v in sub_intermediate.items():
+                intermediate[k] = intermediate.get(k, 0) + amount * v
+        else:
+            raw[materialID] = raw.get(materialID, 0) + amount
+
+    bom_cache[key] = (raw, intermediate)
+
+    return raw, intermediate
+
+# Fully expanded raw and intermediate material totals for a number of blueprint runs
+# Rounding up is only done on the totals so the cached vectors can be shared by every quantity
+def bom_materials(typeID, runs, efficiency=0):
+
+    raw, intermediate = bom_unit_vectors(typeID, efficiency)
+    units = runs * blueprint_quantity(typeID)
+
+    _total = lambda vector: [{'typeID': k, 'quantity': math.ceil(round(v * units, 6))} for k, v in sorted(vector.items())]
+
+    return _total(raw), _total(intermediate)
+
+# Sparse materials matrix (blueprints x type catalog rows) in CSR form used to reprice every blueprint at once
+profit_matrix = None
+
+# Per region price vectors and blueprint valuations keyed by region
+profit_cache = {}
+profit_cache_ttl = 300 # seconds before current prices are pulled from redis again
+
+def _build_profit_matrix():
+
+    catalog = blueprint_catalog
+    counts = np.diff(np.frombuffer(catalog['offsets'], dtype=np.int32))
+
+    # Blueprints without any materials can't be priced and are left out
+    keep = np.flatnonzero(counts > 0)
+    rows = np.full(len(counts), -1, dtype=np.int64)
+    rows[keep] = np.arange(len(keep))
+
+    products = np.frombuffer(catalog['products'], dtype=np.int32)[keep].astype(np.int64)
+    indices = np.fromiter((type_catalog_rows[typeID] for typeID in catalog['material_types']), dtype=np.int64, count=len(catalog['material_types']))
+
+    # Products are priced from the same vector as the materials
+    product_columns = np.fromiter((type_catalog_rows[int(product)] for product in products), dtype=np.int64, count=len(products))
+
+    return {
+        'products': products,
+        'output': np.frombuffer(catalog['output'], dtype=np.int32)[keep].astype(np.float64),
+        'rows': np.repeat(rows, counts),
+        'indices': indices,
+        'data': np.frombuffer(catalog['material_quantities'], dtype=np.int32).astype(np.float64),
+        'product_columns': product_columns,
+        'priced_rows': np.union1d(indices, product_columns),
+        'quantities': {}
+    }
+
+# Pulls current prices into catalog row order for every type used by the materials matrix
+def _load_profit_prices(region):
+
+    pip = re.pipeline()
+    rows = profit_matrix['priced_rows']
+
+    for row in rows:
+        pip.hmget('cur:%s-%s' % (type_catalog_ids[row], region), ['sellPercentile', 'buyPercentile', 'tradeVolume'])
+
+    prices = np.full((len(type_catalog_ids), 3), np.nan)
+    prices[rows] = [[np.nan if v is None else float(v) for v in row] for row in pip.execute()]
+
+    return {
+        'sell': prices[:, 0],
+        'buy': prices[:, 1],
+        'volume': prices[:, 2]
+    }
+
+# Material quantities per run after material efficiency, kept per efficiency level
+# Each material is rounded up on its own like the game and create_portfolio do, but never below one unit
+def _profit_material_quantities(efficiency):
+
+    quantities = profit_matrix['quantities']
+
+    if efficiency not in quantities:
+        quantities[efficiency] = np.maximum(1, np.ceil(profit_matrix['data'] * ((100.0 - efficiency) / 100.0)))
+
+    return quantities[efficiency]
+
+# Material cost per run for every blueprint as a single sparse matrix-vector product
+def _profit_material_cost(prices, efficiency=0):
+
+    matrix = profit_matrix
+
+    return np.bincount(matrix['rows'], weights=_profit_material_quantities(efficiency) * prices[matrix['indices']], minlength=len(matrix['products']))
+
+# Material costs of a valuation are computed once per price type and efficiency
+def profit_material_cost(valuation, material_price, efficiency):
+
+    key = (material_price, efficiency)
+
+    if key not in valuation['cost']:
+        valuation['cost'][key] = _profit_material_cost(valuation['prices'][material_price], efficiency)
+
+    return valuation['cost'][key]
+
+def profit_valuation(region):
+    global profit_matrix
+
+    if profit_matrix is None:
+        profit_matrix = _build_profit_matrix()
+
+    cached = profit_cache.get(region)
+
+    if cached is not None and time.time() - cached['time'] < profit_cache_ttl:
+        return cached
+
+    prices = _load_profit_prices(region)
+    product_columns = profit_matrix['product_columns']
+
+    # Only reprice when the price vectors actually changed since the last pull
+    if cached is not None and all(np.array_equal(prices[k], cached['prices'][k], equal_nan=True) for k in prices):
+        cached['time'] = time.time()
+        return cached
+
+    valuation = {
+        'time': time.time(),
+        'prices': prices,
+        'cost': {},
+        'revenue': {k: prices[k][product_columns] * profit_matrix['output'] for k in ('sell', 'buy')},
+        'volume': prices['volume'][product_columns]
+    }
+
+    profit_cache[region] = valuation
+
+    return valuation
+
+@app.route('/industry/profit', methods=['GET'])
+@verify_jwt
+def industry_profit(user_id, settings):
+
+    if settings.get('premium', False) == False:
+        return jsonify({'error': "A Premium subscription is required to access this endpoint", 'code': 405})
+
+    # Validation
+    try:
+        region = int(request.args.get('region', 10000002))
+        efficiency = int(request.args.get('efficiency', 0))
+        limit = int(request.args.get('limit', 50))
+        min_profit = float(request.args.get('minprofit', 0))
+        min_margin = float(request.args.get('minmargin', -100))
+        max_cost = float(request.args.get('maxcost', 1000000000000))
+        min_volume = float(request.args.get('minvolume', 0))
+        material_price = request.args.get('materialprice', 'sell')
+        product_price = request.args.get('productprice', 'sell')
+        sort = request.args.get('sort', 'profit')
+    except:
+        return jsonify({ 'error': "Invalid query parameters or missing parameter", 'code': 400 })
+
+    if region not in supported_regions:
+        return jsonify({ 'error': "The provided region %s is not supported" % region, 'code': 400 })
+
+    if efficiency < 0 or efficiency > 100:
+        return jsonify({ 'error': "Parameter 'efficiency' must be between 0 and 100", 'code': 400 })
+
+    if limit <= 0 or limit > 500:
+        return jsonify({ 'error': "Parameter 'limit' must be between 1 and 500", 'code': 400 })
+
+    if material_price not in ('buy', 'sell') or product_price not in ('buy', 'sell'):
+        return jsonify({ 'error': "Parameters 'materialprice' and 'productprice' must be either 'buy' or 'sell'", 'code': 400 })
+
+    if sort not in ('profit', 'margin'):
+        return jsonify({ 'error': "Parameter 'sort' must be either 'profit' or 'margin'", 'code': 400 })
+
+    try:
+        valuation = profit_valuation(region)
+    except:
+        traceback.print_exc()
+        return jsonify({ 'error': "There was a problem loading current market prices", 'code': 400 })
+
+    cost = profit_material_cost(valuation, material_price, efficiency)
+    revenue = valuation['revenue'][product_price]
+    volume = valuation['volume']
+    profit = revenue - cost
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margin = profit / cost * 100
+
+    # Blueprints missing a price for the product or any material are dropped
+    mask = np.isfinite(profit) & np.isfinite(margin) & (profit >= min_profit) & (margin >= min_margin) & (cost <= max_cost) & (np.nan_to_num(volume) >= min_volume)
+
+    candidates = np.flatnonzero(mask)
+    ranking = (profit if sort == 'profit' else margin)[candidates]
+
+    if len(candidates) > limit:
+        top = np.argpartition(-ranking, limit - 1)[:limit]
+        candidates = candidates[top]
+        ranking = ranking[top]
+
+    candidates = candidates[np.argsort(-ranking, kind='stable')]
+
+    products = profit_matrix['products']
+
+    return jsonify([{
+        'typeID': int(products[i]),
+        'name': blueprint_name(int(products[i])),
+        'quantity': int(profit_matrix['output'][i]),
+        'revenue': float(revenue[i]),
+        'materialCost': float(cost[i]),
+        'profit': float(profit[i]),
+        'margin': float(margin[i]),
+        'tradeVolume': float(np.nan_to_num(volume[i]))
+    } for i in candidates])
+
+# Inverted blueprint index from material typeID to the products that consume it
+# Entries for a material are stored contiguously between offsets[i] and offsets[i + 1]
+def _build_usedin_index():
+
+    consumers = {}
+
+    for product in blueprint_products():
+
+        materials = blueprint_materials(product)
+        total = sum(quantity for _, quantity in materials)
+
+        for typeID, quantity in materials:
+            consumers.setdefault(typeID, []).append((product, quantity, quantity * 100.0 / total))
+
+    index = {
+        'materials': array('i'),
+        'offsets': array('i', [0]),
+        'products': array('i'),
+        'quantities': array('i'),
+        'shares': array('d')
+    }
+
+    for typeID in sorted(consumers):
+
+        index['materials'].append(typeID)
+
+        for product, quantity, share in sorted(consumers[typeID]):
+            index['products'].append(product)
+            index['quantities'].append(quantity)
+            index['shares'].append(share)
+
+        index['offsets'].append(len(index['products']))
+
+    return index
+
+usedin_index = _build_usedin_index()
+
+startup_marks.append(('blueprint indexes', time.perf_counter()))
+
+def usedin_lookup(typeID):
+
+    i = bisect_left(usedin_index['materials'], typeID)
+
+    if i == len(usedin_index['materials']) or usedin_index['materials'][i] != typeID:
+        return []
+
+    start, end = usedin_index['offsets'][i], usedin_index['offsets'][i + 1]
+
+    return list(zip(usedin_index['products'][start:end], usedin_index['quantities'][start:end], usedin_index['shares'][start:end]))
+
+@app.route('/industry/usedin/<int:typeid>', methods=['GET'])
+@verify_jwt
+def industry_used_in(typeid, user_id, settings):
+
+    if settings.get('premium', False) == False:
+        return jsonify({'error': "A Premium subscription is required to access this endpoint", 'code': 405})
+
+    # Validation
+    try:
+        sort = request.args.get('sort', 'share')
+        limit = int(request.args.get('limit', 100))
+    except:
+        return jsonify({ 'error': "Invalid query parameters or missing parameter", 'code': 400 })
+
+    if sort not in ('share', 'quantity', 'name'):
+        return jsonify({ 'error': "Parameter 'sort' must be one of 'share', 'quantity' or 'name'", 'code': 400 })
+
+    if limit <= 0:
+        return jsonify({ 'error': "Parameter 'limit' must be a positive integer", 'code': 400 })
+
+    results = [{
+        'typeID': product,
+        'name': blueprint_name(product),
+        'quantity': quantity,
+        'outputQuantity': blueprint_quantity(product),
+        'share': share
+    } for product, quantity, share in usedin_lookup(typeid)]
 
-        cost = 0
-        orders = sorted(type_to_order_map[_type], key=lambda doc: doc['price']) if _type in type_to_order_map else []
-        volume_required = type_to_component[_type]['quantity'] * quantity
-        available = 0
-        type_to_result[_type] = {
-            'price': 0,
-            'defecit': 0,
-            'wanted': volume_required,
-            'available': 0
-        }
+    if sort == 'name':
+        results.sort(key=lambda doc: doc['name'])
+    else:
+        results.sort(key=lambda doc: doc[sort], reverse=True)
 
-        for order in orders:
+    return jsonify(results[:limit])
 
-            available += order['volume']
+@app.route('/industry/materials/<int:typeid>', methods=['GET'])
+@verify_jwt
+def industry_materials(typeid, user_id, settings):
 
-            if volume_required == 0:
-                continue
+    if settings.get('premium', False) == False:
+        return jsonify({'error': "A Premium subscription is required to access this endpoint", 'code': 405})
 
-            if order['volume'] > volume_required:
-                cost += order['price'] * volume_required
-                volume_required = 0
-            else:
-                volume_required -= order['volume']
-                cost += order['price'] * order['volume']
+    # Validation
+    try:
+        quantity = int(request.args.get('quantity', 1))
+        efficiency = int(request.args.get('efficiency', 0))
+    except:
+        return jsonify({ 'error': "Invalid query parameters or missing parameter", 'code': 400 })
 
-        if volume_required > 0:
-            type_to_result[_type]['defecit'] = volume_required
+    if not is_blueprint(typeid):
+        return jsonify({ 'error': "The given typeID is not a valid manufacturable item", 'code': 400 })
 
-        type_to_result[_type]['price'] = cost
-        type_to_result[_type]['available'] = available
-        total_cost += cost
+    if quantity <= 0 or quantity > 1000000000:
+        return jsonify({ 'error': "Parameter 'quantity' is outside a reasonable range", 'code': 400 })
+
+    if efficiency < 0 or efficiency > 100:
+        return jsonify({ 'error': "Parameter 'efficiency' must be between 0 and 100", 'code': 400 })
+
+    materials, intermediates = bom_materials(typeid, quantity, efficiency)
 
     return jsonify({
-        'components': type_to_result,
-        'totalCost': total_cost
+        'typeID': typeid,
+        'quantity': quantity,
+        'efficiency': efficiency,
+        'manufacturedQuantity': blueprint_quantity(typeid) * quantity,
+        'materials': materials,
+        'intermediates': intermediates
     })
 
 @app.route('/subscription/subscribe', methods=['POST'])
@@ -940,7 +3187,7 @@ def subscription_subscribe(user_id, settings):
     cost = 150000000
 
     try:
-        subscription = subscription_collection.find_one({'user_id': user_id})
+        subscription = subscription_collection.find_one(user_query(user_id))
 
         if subscription is None:
             raise Exception()
@@ -960,7 +3207,7 @@ def subscription_subscribe(user_id, settings):
      return jsonify({ 'error': "Insufficient balance", 'code': 400 })
 
     try:
-        subscription_collection.find_and_modify({'user_id': user_id}, {
+        subscription_collection.find_and_modify(user_query(user_id), {
             '$set': {
                 'premium': True,
                 'subscription_date': datetime.utcnow()
@@ -979,7 +3226,7 @@ def subscription_subscribe(user_id, settings):
             }
         })
 
-        settings_collection.find_and_modify({'user_id': user_id}, {
+        settings_collection.find_and_modify(user_query(user_id), {
             '$set': {
                 'premium': True,
             },
@@ -1013,7 +3260,7 @@ def subscription_unsubscribe(user_id, settings):
     subscription = None
 
     try:
-        subscription = subscription_collection.find_one({'user_id': user_id})
+        subscription = subscription_collection.find_one(user_query(user_id))
 
         if subscription is None:
             raise Exception()
@@ -1021,7 +3268,7 @@ def subscription_unsubscribe(user_id, settings):
         return jsonify({ 'error': "Failed to look up your subscription status", 'code': 400 })
 
     try:
-        subscription_collection.find_and_modify({'user_id': user_id}, {
+        subscription_collection.find_and_modify(user_query(user_id), {
             '$set': {
                 'premium': False,
                 'subscription_date': None,
@@ -1029,7 +3276,7 @@ def subscription_unsubscribe(user_id, settings):
             }
         })
 
-        settings_collection.find_and_modify({'user_id': user_id}, {
+        settings_collection.find_and_modify(user_query(user_id), {
             '$set': {
                 'premium': False,
                 'api_access': False
@@ -1061,7 +3308,7 @@ def subscription_withdraw_amount(amount, user_id, settings):
     subscription = None
 
     try:
-        subscription = subscription_collection.find_one({'user_id': user_id})
+        subscription = subscription_collection.find_one(user_query(user_id))
 
         if subscription is None:
             raise Exception()
@@ -1074,7 +3321,7 @@ def subscription_withdraw_amount(amount, user_id, settings):
      return jsonify({ 'error': "Insufficient balance", 'code': 400 })
 
     try:
-        subscription_collection.find_and_modify({'user_id': user_id}, {
+        subscription_collection.find_and_modify(user_query(user_id), {
             '$inc': {
                 'balance': -amount
             },
@@ -1118,7 +3365,7 @@ def api_access_enable(user_id, settings):
     pro_rate = 5000000
 
     try:
-        subscription = subscription_collection.find_one({'user_id': user_id})
+        subscription = subscription_collection.find_one(user_query(user_id))
 
         if subscription is None:
             raise Exception()
@@ -1141,7 +3388,7 @@ def api_access_enable(user_id, settings):
      return jsonify({ 'error': "Insufficient balance", 'code': 400 })
 
     try:
-        subscription_collection.find_and_modify({'user_id': user_id}, {
+        subscription_collection.find_and_modify(user_query(user_id), {
             '$set': {
                 'api_access': True
             },
@@ -1159,7 +3406,7 @@ def api_access_enable(user_id, settings):
             }
         })
 
-        settings_collection.find_and_modify({'user_id': user_id}, {
+        settings_collection.find_and_modify(user_query(user_id), {
             '$set': {
                 'api_access': True,
             },
@@ -1193,7 +3440,7 @@ def api_access_disable(user_id, settings):
     subscription = None
 
     try:
-        subscription = subscription_collection.find_one({'user_id': user_id})
+        subscription = subscription_collection.find_one(user_query(user_id))
 
         if subscription is None:
             raise Exception()
@@ -1204,13 +3451,13 @@ def api_access_disable(user_id, settings):
         return jsonify({'error': "API access is currently not enabled on your account", 'code': 400})
 
     try:
-        subscription_collection.find_and_modify({'user_id': user_id}, {
+        subscription_collection.find_and_modify(user_query(user_id), {
             '$set': {
                 'api_access': False
             }
         })
 
-        settings_collection.find_and_modify({'user_id': user_id}, {
+        settings_collection.find_and_modify(user_query(user_id), {
             '$set': {
                 'api_access': False
             },
@@ -1234,6 +3481,45 @@ def api_access_disable(user_id, settings):
 
     return jsonify({ 'message': 'API access has been disabled for your account' })
 
+# Notifications
+
+# Unread counts are cached in redis for a short time since the backend also inserts notifications.
+# Changes made through the API adjust the cached count in place
+notification_unread_ttl = 60
+
+def notification_unread_key(user_id):
+    return 'ntf_unread:%s' % user_id
+
+def notification_unread_count(user_id):
+
+    key = notification_unread_key(user_id)
+    count = re.get(key)
+
+    if count is not None:
+        return int(count)
+
+    count = notification_collection.find(unread_notifications_query(user_id)).count()
+
+    re.setex(key, notification_unread_ttl, count)
+
+    return count
+
+def notification_unread_adjust(user_id, delta):
+
+    key = notification_unread_key(user_id)
+
+    try:
+        pip = re.pipeline()
+        pip.incrby(key, delta)
+        pip.ttl(key)
+        _, ttl = pip.execute()
+
+        # The count wasn't cached, so drop the partial value and recount on the next request
+        if ttl < 0:
+            re.delete(key)
+    except:
+        traceback.print_exc()
+
 @app.route('/notification/<string:not_id>/read', methods=['POST'])
 @verify_jwt
 def notification_set_read(not_id, user_id, settings):
@@ -1249,12 +3535,15 @@ def notification_set_read(not_id, user_id, settings):
         return jsonify({ 'error': "Failed to look up the notification %s" % not_id, 'code': 400 })
 
     try:
-        notification_collection.find_and_modify({'_id': ObjectId(oid=not_id), 'user_id': user_id}, {
+        notification = notification_collection.find_and_modify({'_id': ObjectId(oid=not_id), 'user_id': user_id}, {
             '$set': {
                 'read': True
             }
         })
 
+        if notification is not None and notification.get('read', False) != True:
+            notification_unread_adjust(user_id, -1)
+
         requests.post('http://localhost:4501/publish/notifications/%s' % user_id, timeout=1)
 
     except Exception:
@@ -1268,12 +3557,14 @@ def notification_set_read(not_id, user_id, settings):
 def notification_all_read(user_id, settings):
 
     try:
-        notification_collection.update({'user_id': user_id}, {
+        notification_collection.update(user_query(user_id), {
             '$set': {
                 'read': True
             }
         }, multi=True)
 
+        re.setex(notification_unread_key(user_id), notification_unread_ttl, 0)
+
         requests.post('http://localhost:4501/publish/notifications/%s' % user_id, timeout=1)
 
     except Exception:
@@ -1297,12 +3588,15 @@ def notification_set_unread(not_id, user_id, settings):
         return jsonify({ 'error': "Failed to look up the notification %s" % not_id, 'code': 400 })
 
     try:
-        notification_collection.find_and_modify({'_id': ObjectId(oid=not_id), 'user_id': user_id}, {
+        notification = notification_collection.find_and_modify({'_id': ObjectId(oid=not_id), 'user_id': user_id}, {
             '$set': {
                 'read': False
             }
         })
 
+        if notification is not None and notification.get('read', False) != False:
+            notification_unread_adjust(user_id, 1)
+
         requests.post('http://localhost:4501/publish/notifications/%s' % user_id, timeout=1)
 
     except Exception:
@@ -1317,7 +3611,7 @@ def notification_set_unread(not_id, user_id, settings):
 def notification_get_all(user_id, settings):
 
     try:
-        notifications = list(notification_collection.find({'user_id': user_id}))
+        notifications = list(notification_collection.find(user_query(user_id)))
 
         if notifications == None:
             return jsonify([])
@@ -1333,6 +3627,44 @@ def notification_get_all(user_id, settings):
 
     return jsonify(notifications)
 
+@app.route('/notification/get', methods=['GET'])
+@verify_jwt
+def notification_get_page(user_id, settings):
+
+    # Validation
+    try:
+        cursor, limit = parse_page_args()
+    except ValueError as e:
+        return jsonify({ 'error': str(e), 'code': 400 })
+
+    try:
+        notifications, next_cursor = paginate(notification_collection, user_query(user_id), cursor, limit)
+    except Exception:
+        traceback.print_exc()
+        return jsonify({ 'error': "There was a database error while loading your notifications", 'code': 400 })
+
+    for n in notifications:
+        n['id'] = str(n['_id'])
+        del n['_id']
+        n['time'] = n['time'].isoformat()
+
+    return jsonify({
+        'notifications': notifications,
+        'next': next_cursor
+    })
+
+@app.route('/notification/unread', methods=['GET'])
+@verify_jwt
+def notification_get_unread(user_id, settings):
+
+    try:
+        count = notification_unread_count(user_id)
+    except Exception:
+        traceback.print_exc()
+        return jsonify({ 'error': "There was a database error while counting your notifications", 'code': 400 })
+
+    return jsonify({ 'unread': count })
+
 # API Keys
 
 @app.route('/apikey/add', methods=['POST'])
@@ -1406,6 +3738,11 @@ def apikey_add(user_id, settings):
     try:
         res = requests.get('https://api.eveonline.com/account/APIKeyInfo.xml.aspx?keyID=%s&vCode=%s' % (keyID, vCode), timeout=10, headers=standard_headers)
 
+        try:
+            import xml.etree.cElementTree as ET
+        except ImportError:
+            import xml.etree.ElementTree as ET
+
         tree = ET.fromstring(res.text)
 
         if tree.find('error') is not None:
@@ -1466,7 +3803,7 @@ def apikey_add(user_id, settings):
         return jsonify({'error': "There was an unknown problem grabbing the correct information for this api key", 'code': 400})
 
     # Add api key to account now
-    settings_collection.find_and_modify({'user_id': user_id}, {
+    settings_collection.find_and_modify(user_query(user_id), {
             '$push': {
                 'profiles': {
                     'type': type,
@@ -1526,7 +3863,7 @@ def apikey_remove(key_id, user_id, settings):
         return jsonify({'message': 'Failed to find the requested API key. Make sure to use its unique ID in the request'})
 
     # Query to remove the exact array element
-    settings_collection.find_and_modify({'user_id': user_id}, {
+    settings_collection.find_and_modify(user_query(user_id), {
             '$pull': {
                 'profiles': {
                     'id': key_id
@@ -1796,7 +4133,7 @@ def settings_savee(user_id, settings):
         return jsonify({'error': "There was a problem with parsing your settings", 'code': 400})
 
     try:
-        mongo_db.settings.find_and_modify({'user_id': user_id}, {
+        mongo_db.settings.find_and_modify(user_query(user_id), {
             '$set': {
                 'pinned_charts': pinned_charts,
                 'market': {
@@ -1849,12 +4186,584 @@ def settings_savee(user_id, settings):
                     'canShowBrowserNotification': show_browser,
                     'canSendMailNotification': send_evemail
                 }
-            }
-        })
+            }
+        })
+    except:
+        return jsonify({'error': "There was a problem with saving your settings", 'code': 400})
+
+    return jsonify({'message': 'New settings have been applied'})
+
+# Price alert evaluation
+
+# Thresholds of active price alerts are kept sorted per region and (typeID, price type, comparator) so a price change
+# only visits the alerts whose threshold lies between the previous and the new price. Fired alerts wait on a heap
+# of their region until their nextTrigger and are then checked against the current price again
+# Price types: 0 buy, 1 sell, 2 spread, 3 volume. Comparators: 0 above, 1 below, 2 equal to
+# Alerts created before they had a priceAlertRegion use the market region in the settings of their owner
+# Every worker keeps its own index, so each evaluation first syncs it with the alerts whose updatedAt changed since
+# the last sync, and with the removed alerts when the number of active alerts differs from the tracked ones
+price_alert_fields = ['buyPercentile', 'sellPercentile', 'spread', 'tradeVolume']
+price_alert_type_names = ['buy price', 'sell price', 'spread', 'trade volume']
+price_alert_comparator_names = ['above', 'below', 'equal to']
+price_alert_index = None
+price_alert_state = {}
+price_alert_cooldown = {}
+price_alert_last = {}
+price_alert_synced = None
+price_alert_sync_margin = timedelta(seconds=60) # overlap between syncs to allow for clock differences between workers
+
+# Market regions in the settings of the owners of alerts without a priceAlertRegion
+def _price_alert_regions(alerts):
+
+    user_ids = list(set(alert['user_id'] for alert in alerts if 'priceAlertRegion' not in alert))
+    regions = {}
+
+    if len(user_ids) > 0:
+        for user_settings in settings_collection.find(users_query(user_ids), projection={'_id': False, 'user_id': True, 'market': True}):
+            regions[user_settings['user_id']] = user_settings.get('market', {}).get('region', 10000002)
+
+    return regions
+
+def _price_alert_apply(alerts):
+
+    regions = _price_alert_regions(alerts)
+
+    for alert in alerts:
+        price_alert_refresh(alert, regions.get(alert['user_id'], 10000002))
+
+def price_alert_sync():
+    global price_alert_index, price_alert_synced
+
+    now = datetime.utcnow()
+
+    if price_alert_index is None:
+        price_alert_index = {}
+        _price_alert_apply(list(alerts_collection.find(active_alerts_query(0))))
+    else:
+        _price_alert_apply(list(alerts_collection.find(changed_alerts_query(0, price_alert_synced - price_alert_sync_margin))))
+
+    price_alert_synced = now
+
+    # Removed alerts, or alerts written without an updatedAt, only show up in the number of active alerts
+    if alerts_collection.find(active_alerts_query(0)).count() != len(price_alert_state):
+        active = set(str(doc['_id']) for doc in alerts_collection.find(active_alerts_query(0), projection={'_id': True}))
+
+        for alert_id in [alert_id for alert_id in price_alert_state if alert_id not in active]:
+            price_alert_untrack(alert_id)
+
+        missing = [ObjectId(oid=alert_id) for alert_id in active if alert_id not in price_alert_state]
+
+        if len(missing) > 0:
+            _price_alert_apply(list(alerts_collection.find({'_id': {'$in': missing}})))
+
+# Tracks, retracks or untracks an alert read from the database depending on what changed
+def price_alert_refresh(alert, default_region=10000002):
+
+    alert_id = str(alert['_id'])
+    state = price_alert_state.get(alert_id)
+
+    if alert.get('alertType') != 0 or alert.get('paused', False):
+        price_alert_untrack(alert_id)
+        return
+
+    if state is not None:
+        tracked = (state['region'], state['key'], state['amount'], state['frequency'], state['nextTrigger'])
+        stored = (alert.get('priceAlertRegion', default_region), (alert['priceAlertItemID'], alert['priceAlertPriceType'], alert['priceAlertComparator']), float(alert['priceAlertAmount']), alert['frequency'], alert['nextTrigger'])
+
+        if tracked == stored:
+            return
+
+        price_alert_untrack(alert_id)
+
+    price_alert_track(alert, default_region)
+
+# default_region is used for alerts without a priceAlertRegion and should be the market region of their owner
+def price_alert_track(alert, default_region=10000002):
+
+    if price_alert_index is None or alert.get('alertType') != 0 or alert.get('paused', False):
+        return
+
+    alert_id = str(alert['_id'])
+
+    if alert_id in price_alert_state:
+        return
+
+    region = alert.get('priceAlertRegion', default_region)
+    key = (alert['priceAlertItemID'], alert['priceAlertPriceType'], alert['priceAlertComparator'])
+    amount = float(alert['priceAlertAmount'])
+    entries = price_alert_index.setdefault(region, {}).setdefault(key, {'amounts': [], 'ids': []})
+
+    i = bisect_right(entries['amounts'], amount)
+    entries['amounts'].insert(i, amount)
+    entries['ids'].insert(i, alert_id)
+
+    price_alert_state[alert_id] = {
+        'region': region,
+        'key': key,
+        'amount': amount,
+        'user_id': alert['user_id'],
+        'frequency': alert['frequency'],
+        'nextTrigger': alert['nextTrigger']
+    }
+
+    # Checked against the current price on the next evaluation in case it already matches
+    heappush(price_alert_cooldown.setdefault(region, []), (alert['nextTrigger'], alert_id))
+
+def price_alert_untrack(alert_id):
+
+    state = price_alert_state.pop(alert_id, None)
+
+    if state is None:
+        return
+
+    region_index = price_alert_index[state['region']]
+    entries = region_index[state['key']]
+    i = bisect_left(entries['amounts'], state['amount'])
+
+    while entries['ids'][i] != alert_id:
+        i += 1
+
+    del entries['amounts'][i]
+    del entries['ids'][i]
+
+    if len(entries['ids']) == 0:
+        del region_index[state['key']]
+
+def price_alert_reset(alert_id, now):
+
+    state = price_alert_state.get(alert_id)
+
+    if state is not None:
+        state['nextTrigger'] = now
+        heappush(price_alert_cooldown[state['region']], (now, alert_id))
+
+def _price_alert_matches(comparator, value, amount):
+    return value > amount if comparator == 0 else value < amount if comparator == 1 else value == amount
+
+# Range of thresholds that match the new price but didn't match the previous one. Equal to alerts also match
+# when the price moves past their threshold since prices rarely land on it exactly
+def _price_alert_crossed(comparator, amounts, last, value):
+
+    if comparator == 0:
+        return (0 if last is None else bisect_left(amounts, last)), bisect_left(amounts, value)
+
+    if comparator == 1:
+        return bisect_right(amounts, value), (len(amounts) if last is None else bisect_right(amounts, last))
+
+    if last is None:
+        return bisect_left(amounts, value), bisect_right(amounts, value)
+
+    if value > last:
+        return bisect_right(amounts, last), bisect_right(amounts, value)
+
+    return bisect_left(amounts, value), bisect_left(amounts, last)
+
+def _price_alert_fire(alert_id, state, value, now, fired):
+
+    state['lastTrigger'] = now
+    state['nextTrigger'] = now + timedelta(hours=state['frequency'])
+    heappush(price_alert_cooldown[state['region']], (state['nextTrigger'], alert_id))
+
+    fired.append((alert_id, state, value))
+
+def _price_alert_publish(fired, now):
+
+    frequencies = {}
+    notifications = []
+    users = Counter()
+
+    for alert_id, state, value in fired:
+        typeID, price_type, comparator = state['key']
+
+        frequencies.setdefault(state['frequency'], []).append(ObjectId(oid=alert_id))
+        users[state['user_id']] += 1
+
+        notifications.append({
+            'user_id': state['user_id'],
+            'time': now,
+            'read': False,
+            'message': "Price alert: the %s of %s is now %s, %s your alert at %s" % (price_alert_type_names[price_type], type_name(typeID), '{:,.2f}'.format(value), price_alert_comparator_names[comparator], '{:,.2f}'.format(state['amount']))
+        })
+
+    for frequency, ids in frequencies.items():
+        alerts_collection.update({'_id': {'$in': ids}}, {
+            '$set': {
+                'lastTrigger': now,
+                'nextTrigger': now + timedelta(hours=frequency),
+                'updatedAt': now
+            }
+        }, multi=True)
+
+    notification_collection.insert(notifications)
+
+    for user_id, count in users.items():
+        notification_unread_adjust(user_id, count)
+
+        try:
+            requests.post('http://localhost:4501/publish/notifications/%s' % user_id, timeout=1)
+            requests.post('http://localhost:4501/publish/alerts/%s' % user_id, timeout=1)
+        except:
+            traceback.print_exc()
+
+# Evaluates the tracked alerts of a region against its current prices and returns the alerts that fired
+def price_alert_evaluate(region):
+
+    price_alert_sync()
+
+    # MongoDB keeps milliseconds, so trigger times tracked here compare equal to the stored ones on the next sync
+    now = datetime.utcnow()
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    region_index = price_alert_index.get(region, {})
+    cooldown = price_alert_cooldown.get(region, [])
+    type_ids = sorted(set(key[0] for key in region_index))
+
+    pip = re.pipeline()
+
+    for typeID in type_ids:
+        pip.hmget('cur:%s-%s' % (typeID, region), price_alert_fields)
+
+    values = {}
+
+    for typeID, row in zip(type_ids, pip.execute()):
+        for price_type, value in enumerate(row):
+            if value is not None:
+                values[(typeID, price_type)] = float(value)
+
+    fired = []
+
+    due = []
+
+    while len(cooldown) > 0 and cooldown[0][0] <= now:
+        due.append(heappop(cooldown))
+
+    # Alerts leaving their cooldown fire again if the current price still matches
+    for next_trigger, alert_id in due:
+        state = price_alert_state.get(alert_id)
+
+        if state is None or state['nextTrigger'] != next_trigger:
+            continue
+
+        typeID, price_type, comparator = state['key']
+        value = values.get((typeID, price_type))
+
+        if value is not None and _price_alert_matches(comparator, value, state['amount']):
+            _price_alert_fire(alert_id, state, value, now, fired)
+
+    # Everything else only fires when the price moves across its threshold
+    for (typeID, price_type), value in values.items():
+        last = price_alert_last.get((region, typeID, price_type))
+        price_alert_last[(region, typeID, price_type)] = value
+
+        if last == value:
+            continue
+
+        for comparator in range(len(price_alert_comparator_names)):
+            entries = region_index.get((typeID, price_type, comparator))
+
+            if entries is None:
+                continue
+
+            start, end = _price_alert_crossed(comparator, entries['amounts'], last, value)
+
+            for alert_id in entries['ids'][start:end]:
+                state = price_alert_state[alert_id]
+
+                if state['nextTrigger'] <= now and state.get('lastTrigger') != now:
+                    _price_alert_fire(alert_id, state, value, now, fired)
+
+    if len(fired) > 0:
+        _price_alert_publish(fired, now)
+
+    return fired
+
+@app.route('/admin/alerts/evaluate', methods=['POST'])
+@verify_admin
+def admin_alerts_evaluate():
+
+    # Validation
+    try:
+        region = int(request.args.get('region', 10000002))
+    except:
+        return jsonify({ 'error': "Invalid query parameters or missing parameter", 'code': 400 })
+
+    if region not in supported_regions:
+        return jsonify({ 'error': "The provided region %s is not supported" % region, 'code': 400 })
+
+    try:
+        fired = price_alert_evaluate(region)
+    except:
+        traceback.print_exc()
+        return jsonify({ 'error': "There was a problem evaluating price alerts", 'code': 400 })
+
+    return jsonify({
+        'tracked': len(price_alert_state),
+        'fired': [{
+            'id': alert_id,
+            'user_id': state['user_id'],
+            'typeID': state['key'][0],
+            'value': value
+        } for alert_id, state, value in fired]
+    })
+
+# Sales alert evaluation
+
+# The last seen volRemaining of every order of a user is kept in redis, and each evaluation only reads the orders
+# whose updatedAt changed since the previous one. Orders that disappeared show up as a lower number of orders than
+# tracked, and only then are the order IDs of that user listed. A vanished order counts as filling what remained
+# Sales alert types: 0 sell orders, 1 buy orders, 2 both. A salesAlertProfile of 0 matches every profile
+sales_alert_batch = 100
+sales_alert_ttl = 60 * 60 * 24 * 30
+sales_alert_item_limit = 5
+sales_alert_sync_margin = timedelta(seconds=60) # overlap between evaluations to allow for clock differences
+sales_alert_time_format = '%Y-%m-%dT%H:%M:%S.%f'
+sales_alert_order_fields = {'_id': False, 'user_id': True, 'whoID': True, 'who': True, 'orderID': True, 'volRemaining': True, 'typeID': True, 'bid': True}
+
+# Stored as [whoID, who, typeID, bid, volRemaining] so a vanished order can still be matched and reported
+def _sales_alert_record(order):
+    return json.dumps([order['whoID'], order.get('who'), int(order['typeID']), str(order['bid']), int(order['volRemaining'])])
+
+def _sales_alert_vanished(order_id, record):
+
+    who_id, who, typeID, bid, volume = json.loads(record.decode('utf-8'))
+    order = {'orderID': order_id, 'whoID': who_id, 'typeID': typeID, 'bid': bid, 'volRemaining': 0}
+
+    if who is not None:
+        order['who'] = who
+
+    return order, volume
+
+# Returns the fills of orders changed since the last evaluation as {(user_id, whoID): [(order, amount filled)]}
+def _sales_alert_fills(user_ids):
+
+    now = datetime.utcnow()
+
+    pip = re.pipeline()
+
+    for user_id in user_ids:
+        pip.get('sls_sync:%s' % user_id)
+
+    synced = {user_id: None if value is None else datetime.strptime(value.decode('ascii'), sales_alert_time_format) for user_id, value in zip(user_ids, pip.execute())}
+    known = [user_id for user_id in user_ids if synced[user_id] is not None]
+    first = [user_id for user_id in user_ids if synced[user_id] is None]
+    changed = {}
+
+    # Users seen for the first time have all their orders recorded without firing
+    if len(first) > 0:
+        for order in user_orders_collection.find(users_query(first), fields=sales_alert_order_fields):
+            changed.setdefault(order['user_id'], {})[str(order['orderID'])] = order
+
+    if len(known) > 0:
+        since = min(synced[user_id] for user_id in known) - sales_alert_sync_margin
+
+        for order in user_orders_collection.find(changed_orders_query(known, since), fields=sales_alert_order_fields):
+            changed.setdefault(order['user_id'], {})[str(order['orderID'])] = order
+
+    diffed = [user_id for user_id in known if user_id in changed]
+
+    pip = re.pipeline()
+
+    for user_id in diffed:
+        pip.hmget('sls:%s' % user_id, list(changed[user_id].keys()))
+
+    fills = {}
+    added = Counter()
+
+    for user_id, records in zip(diffed, pip.execute() if len(diffed) > 0 else []):
+        for order, record in zip(changed[user_id].values(), records):
+            if record is None:
+                added[user_id] += 1
+                continue
+
+            filled = json.loads(record.decode('utf-8'))[4] - int(order['volRemaining'])
+
+            if filled > 0:
+                fills.setdefault((user_id, order['whoID']), []).append((order, filled))
+
+    vanished = {}
+
+    if len(known) > 0:
+        counts = {doc['_id']: doc['count'] for doc in user_orders_collection.aggregate([{'$match': users_query(known)}, {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}}], cursor={})}
+
+        pip = re.pipeline()
+
+        for user_id in known:
+            pip.hlen('sls:%s' % user_id)
+
+        for user_id, tracked in zip(known, pip.execute()):
+            if tracked + added[user_id] <= counts.get(user_id, 0):
+                continue
+
+            current = set(str(order['orderID']) for order in user_orders_collection.find(user_query(user_id), fields={'_id': False, 'orderID': True}))
+
+            for order_id, record in re.hgetall('sls:%s' % user_id).items():
+                order_id = order_id.decode('ascii')
+
+                if order_id in current:
+                    continue
+
+                vanished.setdefault(user_id, []).append(order_id)
+                order, volume = _sales_alert_vanished(order_id, record)
+
+                if volume > 0:
+                    fills.setdefault((user_id, order['whoID']), []).append((order, volume))
+
+    pip = re.pipeline()
+
+    for user_id in user_ids:
+        if user_id in changed:
+            pip.hmset('sls:%s' % user_id, {k: _sales_alert_record(order) for k, order in changed[user_id].items()})
+
+        if user_id in vanished:
+            pip.hdel('sls:%s' % user_id, *vanished[user_id])
+
+        pip.expire('sls:%s' % user_id, sales_alert_ttl)
+        pip.setex('sls_sync:%s' % user_id, sales_alert_ttl, now.strftime(sales_alert_time_format))
+
+    pip.execute()
+
+    return fills
+
+def _sales_alert_matches(alert, who_id, order):
+
+    if alert['salesAlertProfile'] != 0 and alert['salesAlertProfile'] != who_id:
+        return False
+
+    buy = str(order['bid']) == '1'
+
+    return alert['salesAlertType'] == 2 or (alert['salesAlertType'] == 1) == buy
+
+def _sales_alert_message(who, orders):
+
+    items = ', '.join('%sx %s' % ('{:,}'.format(filled), type_name(int(order['typeID']))) for order, filled in orders[:sales_alert_item_limit])
+
+    if len(orders) > sales_alert_item_limit:
+        items += ' and %s more' % (len(orders) - sales_alert_item_limit)
+
+    return "Sales alert: %s order%s for %s %s filled: %s" % (len(orders), '' if len(orders) == 1 else 's', who, 'was' if len(orders) == 1 else 'were', items)
+
+# Diffs the changed orders of every user with an active sales alert, or only the given users, in batches
+def sales_alert_evaluate(user_ids=None):
+
+    alerts = {}
+
+    for alert in alerts_collection.find(active_alerts_query(1, user_ids)):
+        alerts.setdefault(alert['user_id'], []).append(alert)
+
+    users = sorted(alerts.keys())
+    fired = []
+
+    for start in range(0, len(users), sales_alert_batch):
+        now = datetime.utcnow()
+        fills = _sales_alert_fills(users[start:start + sales_alert_batch])
+        frequencies = {}
+        notifications = []
+
+        for (user_id, who_id), orders in fills.items():
+            for alert in alerts[user_id]:
+                if alert['nextTrigger'] > now:
+                    continue
+
+                matched = [(order, filled) for order, filled in orders if _sales_alert_matches(alert, who_id, order)]
+
+                if len(matched) == 0:
+                    continue
+
+                alert['nextTrigger'] = now + timedelta(hours=alert['frequency'])
+                frequencies.setdefault(alert['frequency'], []).append(alert['_id'])
+
+                notifications.append({
+                    'user_id': user_id,
+                    'time': now,
+                    'read': False,
+                    'message': _sales_alert_message(matched[0][0].get('who', who_id), matched)
+                })
+
+                fired.append((alert, who_id, len(matched)))
+
+        if len(notifications) == 0:
+            continue
+
+        for frequency, ids in frequencies.items():
+            alerts_collection.update({'_id': {'$in': ids}}, {
+                '$set': {
+                    'lastTrigger': now,
+                    'nextTrigger': now + timedelta(hours=frequency),
+                    'updatedAt': now
+                }
+            }, multi=True)
+
+        notification_collection.insert(notifications)
+
+        for user_id, count in Counter(doc['user_id'] for doc in notifications).items():
+            notification_unread_adjust(user_id, count)
+
+            try:
+                requests.post('http://localhost:4501/publish/notifications/%s' % user_id, timeout=1)
+                requests.post('http://localhost:4501/publish/alerts/%s' % user_id, timeout=1)
+            except:
+                traceback.print_exc()
+
+    return fired
+
+@app.route('/admin/alerts/sales', methods=['POST'])
+@verify_admin
+def admin_alerts_sales():
+
+    # Validation
+    try:
+        user_ids = request.args.get('users', None)
+
+        if user_ids is not None:
+            user_ids = [int(x) for x in user_ids.split(',')]
     except:
-        return jsonify({'error': "There was a problem with saving your settings", 'code': 400})
+        return jsonify({ 'error': "Parameter 'users' must be a comma separated list of user ids", 'code': 400 })
 
-    return jsonify({'message': 'New settings have been applied'})
+    try:
+        fired = sales_alert_evaluate(user_ids)
+    except:
+        traceback.print_exc()
+        return jsonify({ 'error': "There was a problem evaluating sales alerts", 'code': 400 })
+
+    return jsonify({
+        'fired': [{
+            'id': str(alert['_id']),
+            'user_id': alert['user_id'],
+            'whoID': who_id,
+            'orders': count
+        } for alert, who_id, count in fired]
+    })
+
+price_alert_options = {
+    'priceAlertPriceType': int,
+    'priceAlertComparator': int,
+    'priceAlertAmount': [int, float],
+    'priceAlertItemID': int,
+}
+
+# Validates the price alert options of a request, returning an error message if any are invalid
+def price_alert_options_error(options):
+
+    for k in price_alert_options:
+        if k not in options:
+            return "The following option is missing from your request: %s" % k
+        if isinstance(price_alert_options[k], list):
+            valid = next((x for x in price_alert_options[k] if isinstance(options[k], x)), False)
+            if valid == False:
+                return "The following option is not the correct data type: %s" % k
+        else:
+            if not isinstance(options[k], price_alert_options[k]):
+                return "The following option is not the correct data type: %s" % k
+
+    if options['priceAlertPriceType'] < 0 or options['priceAlertPriceType'] > 3:
+        return "Price alert type is invalid"
+    if options['priceAlertComparator'] < 0 or options['priceAlertComparator'] > 2:
+        return "Price comparator type is invalid"
+    if not is_market_type(options['priceAlertItemID']):
+        return "Price alert item id is invalid"
+    if options['priceAlertAmount'] == 0:
+        return "priceAlertAmount should not be 0"
+
+    return None
 
 @app.route('/alerts/create', methods=['POST'])
 @verify_jwt
@@ -1873,13 +4782,6 @@ def create_alert(user_id, settings):
             'frequency': int
         }
 
-        price_alert_options = {
-            'priceAlertPriceType': int,
-            'priceAlertComparator': int,
-            'priceAlertAmount': [int, float],
-            'priceAlertItemID': int,
-        }
-
         sales_alert_options = {
             'salesAlertType': int,
             'salesAlertProfile': int
@@ -1908,31 +4810,22 @@ def create_alert(user_id, settings):
 
         if alert_type == 0:
 
-            for k in price_alert_options:
-                if k not in request.json:
-                    return jsonify({ 'error': "The following option is missing from your request: %s" % k, 'code': 400 })
-                if isinstance(price_alert_options[k], list):
-                    valid = next((x for x in price_alert_options[k] if isinstance(request.json[k], x)), False)
-                    if valid == False:
-                        return jsonify({ 'error': "The following option is not the correct data type: %s" % k, 'code': 400 })
-                else:
-                    if not isinstance(request.json[k], price_alert_options[k]):
-                        return jsonify({ 'error': "The following option is not the correct data type: %s" % k, 'code': 400 })
+            error = price_alert_options_error(request.json)
+
+            if error is not None:
+                return jsonify({ 'error': error, 'code': 400 })
+
+            region = request.json.get('priceAlertRegion', settings.get('market', {}).get('region', 10000002))
+
+            if region not in supported_regions:
+                return jsonify({ 'error': "The provided region %s is not supported" % region, 'code': 400 })
 
             new_alert = {
                 **{k:request.json[k] for k in req_options.keys()},
-                **{k:request.json[k] for k in price_alert_options.keys()}
+                **{k:request.json[k] for k in price_alert_options.keys()},
+                'priceAlertRegion': region
             }
 
-            if new_alert['priceAlertPriceType'] < 0 or new_alert['priceAlertPriceType'] > 3:
-                return jsonify({ 'error': "Price alert type is invalid", 'code': 400 })
-            if new_alert['priceAlertComparator'] < 0 or new_alert['priceAlertComparator'] > 2:
-                return jsonify({ 'error': "Price comparator type is invalid", 'code': 400 })
-            if str(new_alert['priceAlertItemID']) not in market_ids:
-                return jsonify({ 'error': "Price alert item id is invalid", 'code': 400 })
-            if new_alert['priceAlertAmount'] == 0:
-                return jsonify({ 'error': "priceAlertAmount should not be 0", 'code': 400 })
-
         elif alert_type == 1:
 
             for k in sales_alert_options:
@@ -1946,14 +4839,20 @@ def create_alert(user_id, settings):
                 **{k:request.json[k] for k in sales_alert_options.keys()}
             }
 
+            if new_alert['salesAlertType'] < 0 or new_alert['salesAlertType'] > 2:
+                return jsonify({ 'error': "Sales alert type is invalid", 'code': 400 })
+
         new_alert['user_id'] = user_id
         new_alert['nextTrigger'] = datetime.utcnow()
         new_alert['paused'] = False
         new_alert['createdAt'] = datetime.utcnow()
+        new_alert['updatedAt'] = new_alert['createdAt']
         new_alert['lastTrigger'] = None
 
         alerts_collection.insert(new_alert)
 
+        price_alert_track(new_alert)
+
         audit = {
             'user_id': user_id,
             'target': alert_type,
@@ -1983,7 +4882,7 @@ def create_alert(user_id, settings):
 def alert_toggle(id, user_id, settings):
 
     try:
-        alert = alerts_collection.find_one({'user_id': user_id, '_id': ObjectId(oid=id)})
+        alert = alerts_collection.find_one(alert_query(user_id, id))
 
         if alert is None:
             raise Exception()
@@ -1993,12 +4892,18 @@ def alert_toggle(id, user_id, settings):
     
     new_state = False if alert['paused'] == True else True
 
-    alerts_collection.find_and_modify({'user_id': user_id, '_id': ObjectId(oid=id)}, {
+    alerts_collection.find_and_modify(alert_query(user_id, id), {
         '$set': {
-            'paused': new_state
+            'paused': new_state,
+            'updatedAt': datetime.utcnow()
         }
     })
 
+    if new_state == True:
+        price_alert_untrack(id)
+    else:
+        price_alert_track(dict(alert, paused=False), settings.get('market', {}).get('region', 10000002))
+
     requests.post('http://localhost:4501/publish/alerts/%s' % user_id, timeout=1)
 
     return jsonify({'message': "Alert %s is %s" % (id, 'now paused' if new_state == True else 'no longer paused')})
@@ -2008,7 +4913,7 @@ def alert_toggle(id, user_id, settings):
 def alert_reset(id, user_id, settings):
 
     try:
-        alert = alerts_collection.find_one({'user_id': user_id, '_id': ObjectId(oid=id)})
+        alert = alerts_collection.find_one(alert_query(user_id, id))
 
         if alert is None:
             raise Exception()
@@ -2018,12 +4923,17 @@ def alert_reset(id, user_id, settings):
     
     new_state = False if alert['paused'] == True else True
 
-    alerts_collection.find_and_modify({'user_id': user_id, '_id': ObjectId(oid=id)}, {
+    now = datetime.utcnow()
+
+    alerts_collection.find_and_modify(alert_query(user_id, id), {
         '$set': {
-            'nextTrigger': datetime.utcnow()
+            'nextTrigger': now,
+            'updatedAt': now
         }
     })
 
+    price_alert_reset(id, now)
+
     requests.post('http://localhost:4501/publish/alerts/%s' % user_id, timeout=1)
 
     return jsonify({'message': "Alert delay has been reset"})
@@ -2033,7 +4943,7 @@ def alert_reset(id, user_id, settings):
 def alert_remove(id, user_id, settings):
 
     try:
-        alert = alerts_collection.find_one({'user_id': user_id, '_id': ObjectId(oid=id)})
+        alert = alerts_collection.find_one(alert_query(user_id, id))
 
         if alert is None:
             raise Exception()
@@ -2042,7 +4952,9 @@ def alert_remove(id, user_id, settings):
         return jsonify({ 'error': "Failed to look up the requested alert", 'code': 400 })
 
     try:
-        alerts_collection.remove({'user_id': user_id, '_id': ObjectId(oid=id)}, multi=False)
+        alerts_collection.remove(alert_query(user_id, id), multi=False)
+
+        price_alert_untrack(id)
 
         audit = {
             'user_id': user_id,
@@ -2063,24 +4975,162 @@ def alert_remove(id, user_id, settings):
 
     return jsonify({'message': "Alert %s has been removed" % id})
 
+# Alert back-testing
+
+backtest_collections = {
+    'hourly': aggregates_hourly,
+    'daily': aggregates_daily
+}
+
+# Seconds that a loaded series is reused for before it's read again
+backtest_series_ttl = {
+    'hourly': 300,
+    'daily': 3600
+}
+
+backtest_epoch = datetime(1970, 1, 1)
+
+# Sample times in seconds and a row of values per price type, oldest first. The bucket argument expires the cache
+@lru_cache(maxsize=256)
+def _backtest_series(resolution, typeID, region, bucket):
+
+    times = []
+    values = []
+
+    for doc in backtest_collections[resolution].find(history_query(typeID), fields={'_id': False, 'time': True, 'regions': {'$elemMatch': {'region': region}}}).sort(history_sort):
+        if len(doc.get('regions', [])) == 0:
+            continue
+
+        times.append((doc['time'] - backtest_epoch).total_seconds())
+        values.append([float(doc['regions'][0].get(k, np.nan)) for k in price_alert_fields])
+
+    return np.array(times, dtype=np.float64), np.array(values, dtype=np.float64).reshape(len(values), len(price_alert_fields)).T
+
+def backtest_series(resolution, typeID, region):
+    return _backtest_series(resolution, typeID, region, int(time.time() // backtest_series_ttl[resolution]))
+
+# Samples where the alert condition holds, matching price_alert_evaluate including equal to alerts
+# that fire when the price moves past their threshold
+def backtest_hits(values, comparator, amount):
+
+    with np.errstate(invalid='ignore'):
+        if comparator == 0:
+            return values > amount
+
+        if comparator == 1:
+            return values < amount
+
+        previous = np.concatenate(([np.nan], values[:-1]))
+
+        return (values == amount) | ((previous < amount) & (amount <= values)) | ((values <= amount) & (amount < previous))
+
+# Times of the hits that fire once the previous firing is at least cooldown seconds old
+def backtest_fires(hit_times, cooldown):
+
+    fires = []
+    i = 0
+
+    while i < len(hit_times):
+        fires.append(hit_times[i])
+        i = max(i + 1, int(np.searchsorted(hit_times, hit_times[i] + cooldown, side='left')))
+
+    return fires
+
+@app.route('/alerts/backtest', methods=['POST'])
+@verify_jwt
+def alert_backtest(user_id, settings):
+
+    try:
+        if request.is_json == False:
+            return jsonify({'error': "Request Content-Type header must be set to 'application/json'", 'code': 400})
+
+        options = request.json
+    except:
+        return jsonify({ 'error': "There was a problem parsing your json request", 'code': 400 })
+
+    # Validation
+    if not isinstance(options.get('frequency', None), int):
+        return jsonify({ 'error': "The following option is missing from your request or is incorrect: frequency", 'code': 400 })
+    if options['frequency'] > 720:
+        return jsonify({ 'error': "Alert frequency should be a lower number (in hours)", 'code': 400 })
+    if options['frequency'] < 0:
+        return jsonify({ 'error': "Alert frequency should not be a negative number", 'code': 400 })
+
+    error = price_alert_options_error(options)
+
+    if error is not None:
+        return jsonify({ 'error': error, 'code': 400 })
+
+    resolution = options.get('resolution', 'hourly')
+    region = options.get('priceAlertRegion', options.get('region', settings.get('market', {}).get('region', 10000002)))
+
+    if resolution not in backtest_collections:
+        return jsonify({ 'error': "Option 'resolution' must be either 'hourly' or 'daily'", 'code': 400 })
+
+    if region not in supported_regions:
+        return jsonify({ 'error': "The provided region %s is not supported" % region, 'code': 400 })
+
+    try:
+        times, values = backtest_series(resolution, options['priceAlertItemID'], region)
+    except:
+        traceback.print_exc()
+        return jsonify({ 'error': "There was a problem loading the market history for this item", 'code': 400 })
+
+    hits = backtest_hits(values[options['priceAlertPriceType']], options['priceAlertComparator'], float(options['priceAlertAmount']))
+    fires = backtest_fires(times[hits], options['frequency'] * 3600)
+
+    return jsonify({
+        'samples': len(times),
+        'hits': int(np.count_nonzero(hits)),
+        'fires': len(fires),
+        'start': datetime.utcfromtimestamp(times[0]).isoformat() if len(times) > 0 else None,
+        'end': datetime.utcfromtimestamp(times[-1]).isoformat() if len(times) > 0 else None,
+        'times': [datetime.utcfromtimestamp(t).isoformat() for t in fires]
+    })
+
 # SDE - deprecated
 
+# Payloads are compressed once when the SDE snapshot is built and only change along with the SDE
+# Clients that don't accept gzip get the payload decompressed on the fly
+# The URLs aren't versioned, so responses are only cached briefly and then revalidated with the ETag of their encoding
+sde_max_age = 3600
+
+def sde_response(name):
+
+    payload = sde_payloads[name]
+    compressed = request.accept_encodings['gzip'] > 0
+    etag = payload['etag'] + '-gz' if compressed else payload['etag']
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif compressed:
+        response = Response(payload['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(gzip.decompress(payload['gzip']), mimetype='application/json')
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=%s, must-revalidate' % sde_max_age
+    response.headers['Vary'] = 'Accept-Encoding'
+
+    return response
+
 @app.route('/sde/blueprints', methods=['GET'])
 def sde_blueprints():
 
-    return Response(blueprints_json)
+    return sde_response('blueprints')
 
 @app.route('/sde/marketgroups', methods=['GET'])
 def sde_marketgroups():
 
-    return Response(market_groups_json)
+    return sde_response('market_groups')
 
 # OAuth
 
 @app.route('/oauth')
 def do_oauth():
     session['evesso_state'] = gen_salt(10)
-    return evesso.authorize(callback=url_for('do_oauth_authorized', _external=True))
+    return get_evesso().authorize(callback=url_for('do_oauth_authorized', _external=True))
 
 @app.route('/oauth/verify')
 def do_oauth_authorized():
@@ -2091,7 +5141,7 @@ def do_oauth_authorized():
 
     del session['evesso_state']
 
-    resp = evesso.authorized_response()
+    resp = get_evesso().authorized_response()
     if resp is None or resp.get('access_token') is None:
         return 'Access denied: reason=%s error=%s resp=%s' % (
             request.args['error'],
@@ -2101,7 +5151,7 @@ def do_oauth_authorized():
 
     session['evesso_token'] = (resp['access_token'], '')
 
-    me = evesso.get('oauth/verify')
+    me = get_evesso().get('oauth/verify')
 
     token = jwt.encode({'user_id': me.data['CharacterID'],
                         'user_name': me.data['CharacterName'],
@@ -2110,6 +5160,112 @@ def do_oauth_authorized():
 
     return redirect('%s/?token=%s' % (redirect_host, token.decode('ascii')), code=302)
 
+# Solar system search
+
+# Trigram and prefix index over the system names used to narrow candidates before scoring them
+system_search_index = None
+system_search_candidates = 50
+system_search_limit = 6
+
+def _trigrams(text):
+
+    padded = '  %s ' % text
+
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def _build_system_search_index():
+
+    from fuzzywuzzy import utils
+
+    names = sorted(system_name_to_id.keys())
+    processed = [utils.full_process(name) for name in names]
+    trigrams = {}
+    lengths = {}
+
+    for i, text in enumerate(processed):
+        for trigram in _trigrams(text):
+            trigrams.setdefault(trigram, []).append(i)
+
+        lengths.setdefault(len(text), []).append(i)
+
+    return {
+        'names': names,
+        'processed': processed,
+        'characters': [Counter(text) for text in processed],
+        'trigrams': trigrams,
+        'lengths': lengths,
+        'prefixes': sorted((text, i) for i, text in enumerate(processed))
+    }
+
+# Upper bound of fuzz.ratio for a number of matching characters, rounded the same way
+def _ratio_bound(matches, total):
+
+    return int(round(200.0 * matches / total))
+
+# Results are the same as fuzz.ratio over every name. Names sharing the most trigrams with the query or starting
+# with it are scored first, every other name is only scored if its length and characters could still beat the
+# current results
+@lru_cache(maxsize=1024)
+def search_system_names(name):
+    global system_search_index
+
+    from fuzzywuzzy import fuzz, utils
+
+    if system_search_index is None:
+        system_search_index = _build_system_search_index()
+
+    index = system_search_index
+    query = utils.full_process(name)
+
+    if len(query) == 0:
+        return ()
+
+    counts = Counter()
+
+    for trigram in _trigrams(query):
+        counts.update(index['trigrams'].get(trigram, ()))
+
+    candidates = set(i for i, _ in counts.most_common(system_search_candidates))
+
+    start = bisect_left(index['prefixes'], (query,))
+
+    for text, i in index['prefixes'][start:start + system_search_candidates]:
+        if not text.startswith(query):
+            break
+
+        candidates.add(i)
+
+    scored = sorted((-fuzz.ratio(query, index['processed'][i]), i) for i in candidates)[:system_search_limit]
+
+    query_characters = Counter(query)
+    query_length = len(query)
+    lengths = sorted(index['lengths'].keys(), key=lambda length: -min(length, query_length) / float(length + query_length))
+
+    for length in lengths:
+        total = length + query_length
+
+        if len(scored) == system_search_limit and _ratio_bound(min(length, query_length), total) < -scored[-1][0]:
+            break
+
+        for i in index['lengths'][length]:
+            if i in candidates:
+                continue
+
+            if len(scored) == system_search_limit:
+                matches = sum((query_characters & index['characters'][i]).values())
+
+                if _ratio_bound(matches, total) < -scored[-1][0]:
+                    continue
+
+            score = (-fuzz.ratio(query, index['processed'][i]), i)
+
+            if len(scored) < system_search_limit or score < scored[-1]:
+                scored.append(score)
+                scored.sort()
+                del scored[system_search_limit:]
+
+    return tuple(index['names'][i] for _, i in scored)
+
 @app.route('/search/systems', methods=['GET'])
 def search_systems():
 
@@ -2122,13 +5278,217 @@ def search_systems():
     if name is None:
         return jsonify({'error': "No search string was provided", 'code': 400})
 
-    tokens = process.extract(name, system_name_to_id.keys(), limit=6, scorer=fuzz.ratio)
-
-    results = [{'name': token[0], 'id': system_name_to_id[token[0]]} for token in tokens]
+    results = [{'name': system, 'id': system_name_to_id[system]} for system in search_system_names(name)]
 
     return jsonify(results)
 
-@evesso.tokengetter
+# Item search
+
+# Sorted word list over market item and blueprint product names. Every query word has to prefix a word of the name.
+# Rows are also ranked once by name length, and the rows having a word with a given short prefix are kept
+# in that order so short queries don't have to scan and sort the large ranges of the word list
+item_search_index = None
+item_search_prefix = 3 # Longest prefix with a precomputed row list
+item_search_pool = 100
+item_search_max_limit = 50
+
+def _item_words(text):
+    return regex.findall(r'\w+', text.lower())
+
+def _build_item_search_index():
+
+    names = {}
+
+    def _getItems(group):
+        for item in group.get('items', []):
+            names.setdefault(int(item['id']), item['name'])
+
+        for _group in group['childGroups']:
+            _getItems(_group)
+
+    for group in market_groups:
+        _getItems(group)
+
+    for product in blueprint_products():
+        names.setdefault(product, blueprint_name(product))
+
+    type_ids = sorted(names, key=lambda typeID: (names[typeID].lower(), typeID))
+    normalized = [' '.join(_item_words(names[typeID])) for typeID in type_ids]
+    row_words = [tuple(set(name.split(' '))) for name in normalized]
+    words = []
+
+    for i, typeID in enumerate(type_ids):
+        for word in row_words[i]:
+            words.append((word, i))
+
+    rank_order = sorted(range(len(type_ids)), key=lambda i: (len(normalized[i]), i))
+    rank = array('i', bytes(4 * len(type_ids)))
+    row_prefixes = [frozenset(word[:length] for word in row_words[i] for length in range(1, item_search_prefix + 1)) for i in range(len(type_ids))]
+    prefixes = {}
+
+    for position, i in enumerate(rank_order):
+        rank[i] = position
+
+        for prefix in row_prefixes[i]:
+            prefixes.setdefault(prefix, array('i')).append(i)
+
+    return {
+        'type_ids': array('i', type_ids),
+        'rows': {typeID: i for i, typeID in enumerate(type_ids)},
+        'names': [names[typeID] for typeID in type_ids],
+        'normalized': normalized,
+        'sorted_names': sorted((name, i) for i, name in enumerate(normalized)),
+        'row_words': row_words,
+        'row_prefixes': row_prefixes,
+        'words': sorted(words),
+        'rank': rank,
+        'prefixes': prefixes
+    }
+
+# Name of a market item or blueprint product, falling back to the typeID
+def type_name(typeID):
+    global item_search_index
+
+    if item_search_index is None:
+        item_search_index = _build_item_search_index()
+
+    row = item_search_index['rows'].get(typeID)
+
+    return item_search_index['names'][row] if row is not None else str(typeID)
+
+# Range of the word list holding the words that start with word
+def _item_word_range(word):
+
+    words = item_search_index['words']
+
+    return bisect_left(words, (word,)), bisect_left(words, (word + '\U0010ffff',))
+
+# 0 for an exact name, 1 for a name starting with the query and 2 for names only matching word by word
+def _item_search_tier(i, query):
+
+    name = item_search_index['normalized'][i]
+
+    return 0 if name == query else 1 if name.startswith(query) else 2
+
+# Rows of the best matching names by tier, then shorter names first
+@lru_cache(maxsize=1024)
+def search_item_rows(query):
+    global item_search_index
+
+    if item_search_index is None:
+        item_search_index = _build_item_search_index()
+
+    index = item_search_index
+    words = _item_words(query)
+
+    if len(words) == 0:
+        return ()
+
+    query = ' '.join(words)
+    rank = index['rank']
+
+    # Names starting with the query come first. They're sorted by name so exact names lead the range
+    names = index['sorted_names']
+    start = bisect_left(names, (query,))
+    end = bisect_left(names, (query + '\U0010ffff',))
+    exact = bisect_left(names, (query + ' ',), start, end)
+
+    results = [i for _, i in names[start:exact]]
+    results.extend(sorted([i for _, i in names[exact:end]], key=rank.__getitem__)[:item_search_pool - len(results)])
+    del results[item_search_pool:]
+
+    if len(results) == item_search_pool:
+        return tuple(results)
+
+    # The rest are visited in rank order starting from the rows of the word that matches the fewest. Other words must
+    # have their short prefix among the prefixes of the row, and longer words are then checked in full
+    counts = {}
+
+    for word in set(words):
+        if len(word) <= item_search_prefix:
+            counts[word] = len(index['prefixes'].get(word, ()))
+        else:
+            start, end = _item_word_range(word)
+            counts[word] = end - start
+
+    chosen = min(counts, key=counts.get)
+
+    if counts[chosen] == 0:
+        return tuple(results)
+
+    candidates = index['prefixes'].get(chosen[:item_search_prefix], ())
+
+    # A long word matching far fewer rows than its prefix is cheaper to read from the word list and sort
+    if counts[chosen] * 4 < len(candidates):
+        start, end = _item_word_range(chosen)
+        candidates = sorted(set(i for _, i in index['words'][start:end]), key=rank.__getitem__)
+
+    needed = frozenset(word[:item_search_prefix] for word in counts)
+    longer = [word for word in counts if len(word) > item_search_prefix]
+    skip = set(results)
+
+    for i in candidates:
+        if i not in skip and needed <= index['row_prefixes'][i] and all(any(text.startswith(word) for text in index['row_words'][i]) for word in longer):
+            results.append(i)
+
+            if len(results) == item_search_pool:
+                break
+
+    return tuple(results)
+
+@app.route('/search/items', methods=['GET'])
+def search_items():
+
+    # Validation
+    try:
+        name = request.args.get('name', None)
+        limit = int(request.args.get('limit', 10))
+        region = request.args.get('region', None)
+
+        if region is not None:
+            region = int(region)
+    except:
+        return jsonify({ 'error': "Invalid type used in query parameters", 'code': 400 })
+
+    if name is None:
+        return jsonify({'error': "No search string was provided", 'code': 400})
+
+    if limit <= 0 or limit > item_search_max_limit:
+        return jsonify({ 'error': "Parameter 'limit' must be between 1 and %s" % item_search_max_limit, 'code': 400 })
+
+    if region is not None and region not in supported_regions:
+        return jsonify({ 'error': "The provided region %s is not supported" % region, 'code': 400 })
+
+    rows = search_item_rows(name)
+    index = item_search_index
+
+    results = [{
+        'id': index['type_ids'][i],
+        'name': index['names'][i],
+        'market': is_market_type(index['type_ids'][i])
+    } for i in rows]
+
+    # Within the same tier names are ordered by current trade volume in the region
+    if region is not None and len(rows) > 0:
+        try:
+            pip = re.pipeline()
+
+            for doc in results:
+                pip.hget('cur:%s-%s' % (doc['id'], region), 'tradeVolume')
+
+            for doc, volume in zip(results, pip.execute()):
+                doc['tradeVolume'] = float(volume) if volume is not None else 0
+        except:
+            traceback.print_exc()
+            return jsonify({ 'error': "There was a problem loading current market volumes", 'code': 400 })
+
+        query = ' '.join(_item_words(name))
+        tiers = {i: _item_search_tier(i, query) for i in rows}
+
+        results = [doc for _, doc in sorted(zip(rows, results), key=lambda pair: (tiers[pair[0]], -pair[1]['tradeVolume']))]
+
+    return jsonify(results[:limit])
+
 def get_evesso_oauth_token():
     return session.get('evesso_token')
 
@@ -2303,7 +5663,7 @@ def do_deepstream_authorize():
 
         _data = jwt.decode(request.json['authData']['token'], auth_jwt_secret)
 
-        user_doc = mongo_db.users.find_one({'user_id': _data['user_id']})
+        user_doc = mongo_db.users.find_one(user_query(_data['user_id']))
 
         if user_doc is None:
 
@@ -2321,7 +5681,7 @@ def do_deepstream_authorize():
             # Publish new user
             requests.post('http://localhost:4501/user/create', json=settings_doc, timeout=1)
         else:
-            settings_doc = mongo_db.settings.find_one({'user_id': _data['user_id']})
+            settings_doc = mongo_db.settings.find_one(user_query(_data['user_id']))
             mongo_db.users.update({'_id': user_doc['_id']}, { '$set': { 'last_online': datetime.now()}})
 
         try:
@@ -2370,11 +5730,134 @@ def auth_error(error):
 def not_allowed(error):
     return jsonify({ 'error': "Method or endpoint is not allowed", 'code': 405 })
 
+startup_marks.append(('routes', time.perf_counter()))
+
+# Indexes
+
+# Creating an index that already exists is a no-op, so this is safe to run on every start
+def ensure_indexes(collection=None, database=None):
+
+    database = mongo_db if database is None else database
+    names = []
+
+    for name, keys, options in index_manifest:
+        if collection is None or name == collection:
+            names.append('%s.%s' % (name, database[name].create_index(keys, background=True, **options)))
+
+    return names
+
+# Each query the routes make as (description, collection, query, sort), built from the definitions under # Queries
+query_plan_checks = [
+    ('authorization by token', 'settings', user_query(0), None),
+    ('authorization by api key', 'settings', api_key_query(''), None),
+    ('alert owner regions', 'settings', users_query([0]), None),
+    ('deepstream login', 'users', user_query(0), None),
+    ('subscription', 'subscription', user_query(0), None),
+    ('portfolio by id', 'portfolios', portfolio_query(0, 0), None),
+    ('portfolios of a user', 'portfolios', user_query(0), None),
+    ('next portfolio id', 'portfolios', {}, next_portfolio_sort),
+    ('portfolio chart', 'portfolio_charts', portfolio_chart_query(0, 'hourly', 0, 0), portfolio_chart_sort),
+    ('regional forecast', 'orders', region_orders_query(10000002, False), None),
+    ('5 minute history', 'aggregates_minutes', history_query(34), None),
+    ('price generation', 'aggregates_minutes', {}, latest_aggregate_sort),
+    ('hourly history', 'aggregates_hourly', history_query(34), None),
+    ('daily history', 'aggregates_daily', history_query(34), None),
+    ('alert back-test', 'aggregates_hourly', history_query(34), history_sort),
+    ('alert by id', 'alerts', alert_query(0, ObjectId()), None),
+    ('price alert evaluation', 'alerts', active_alerts_query(0), None),
+    ('price alert sync', 'alerts', changed_alerts_query(0, datetime.utcnow()), None),
+    ('sales alert evaluation', 'alerts', active_alerts_query(1, [0]), None),
+    ('notification page', 'notifications', page_query(user_query(0), ObjectId()), page_sort),
+    ('unread notifications', 'notifications', unread_notifications_query(0), None),
+    ('own orders page', 'user_orders', page_query(user_query(0), None), page_sort),
+    ('sales alert orders', 'user_orders', users_query([0]), None),
+    ('sales alert changed orders', 'user_orders', changed_orders_query([0], datetime.utcnow()), None)
+]
+
+# True if any stage of an explain() result reads the whole collection
+def _plan_scans_collection(plan):
+
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN' or str(plan.get('cursor', '')).startswith('BasicCursor'):
+            return True
+
+        return any(_plan_scans_collection(value) for value in plan.values())
+
+    if isinstance(plan, list):
+        return any(_plan_scans_collection(value) for value in plan)
+
+    return False
+
+# True if the winning plan of a query reads the whole collection
+def query_scans_collection(collection, query, sort=None):
+
+    cursor = collection.find(query)
+
+    if sort is not None:
+        cursor = cursor.sort(sort)
+
+    plan = cursor.explain()
+
+    # MongoDB 3.0 and later nest the chosen plan, older servers describe it at the top level
+    return _plan_scans_collection(plan.get('queryPlanner', {}).get('winningPlan', plan))
+
+# Returns the checks that would scan a whole collection, or whose collection doesn't exist yet
+def check_query_plans(database=None):
+
+    database = mongo_db if database is None else database
+    collections = set(database.collection_names())
+    failures = []
+
+    for description, name, query, sort in query_plan_checks:
+        if name not in collections:
+            failures.append((description, "collection %s does not exist" % name))
+        elif query_scans_collection(database[name], query, sort):
+            failures.append((description, "query on %s scans the whole collection" % name))
+
+    return failures
+
+def startup_report():
+
+    lines = ['Startup took %.1f ms' % ((startup_marks[-1][1] - startup_marks[0][1]) * 1000)]
+
+    for (_, previous), (name, mark) in zip(startup_marks, startup_marks[1:]):
+        lines.append('  %-40s %8.1f ms' % (name, (mark - previous) * 1000))
+
+    return '\n'.join(lines)
+
 # Start server
 if __name__ == '__main__':
-    if debug:
-        app.run(debug=debug, port=port, host='0.0.0.0', threaded=False)
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate-charts':
+        print("Moved charts out of %s portfolios" % migrate_portfolio_charts())
+    elif len(sys.argv) > 1 and sys.argv[1] == 'build-snapshot':
+        snapshot = build_sde_snapshot({'system_name_to_id': system_name_to_id}, refresh_systems=True)
+        print("Wrote SDE snapshot to %s with %s solar systems" % (sde_snapshot_path, len(snapshot['system_name_to_id'])))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'ensure-indexes':
+        print('\n'.join(ensure_indexes()))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'check-query-plans':
+        failures = check_query_plans()
+
+        for description, reason in failures:
+            print("%s: %s" % (description, reason))
+
+        print("%s of %s query plans use an index" % (len(query_plan_checks) - len(failures), len(query_plan_checks)))
+        sys.exit(1 if len(failures) > 0 else 0)
     else:
-        print("Running in production WSGI mode on port %s" % port)
-        http_server = WSGIServer(('', port), app)
-        http_server.serve_forever()
+        if ensure_indexes_on_start:
+            try:
+                ensure_indexes()
+            except:
+                traceback.print_exc()
+
+            startup_marks.append(('mongo indexes', time.perf_counter()))
+
+        print(startup_report())
+
+        hub_monitor_start()
+
+        if debug:
+            app.run(debug=debug, port=port, host='0.0.0.0', threaded=False)
+        else:
+            print("Running in production WSGI mode on port %s" % port)
+            http_server = WSGIServer(('', port), app)
+            http_server.serve_forever()
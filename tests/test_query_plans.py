@@ -0,0 +1,83 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from pymongo import MongoClient
+
+# Runs against the MongoDB at ETF_API_TEST_MONGO_URI in a scratch database that is dropped afterwards
+# Run from the repository root, since importing the server loads the SDE from relative paths:
+#   python -m unittest discover -s tests
+# Importing the server builds its SDE snapshot from the checked in files only, so no network access is needed
+mongo_uri = os.environ.get('ETF_API_TEST_MONGO_URI', 'mongodb://localhost:27017')
+database_name = 'eveexchange_query_plans'
+
+server = None
+client = None
+database = None
+snapshot_dir = None
+
+def setUpModule():
+    global server, client, database, snapshot_dir
+
+    try:
+        client = MongoClient(mongo_uri, connectTimeoutMS=2000)
+        client.server_info()
+    except:
+        raise unittest.SkipTest("No MongoDB available at %s" % mongo_uri)
+
+    # The snapshot and blueprint catalog are written outside of the working tree
+    snapshot_dir = tempfile.mkdtemp()
+    os.environ['ETF_API_SDE_SNAPSHOT'] = os.path.join(snapshot_dir, 'snapshot.pickle')
+    os.environ['ETF_API_BLUEPRINT_CATALOG'] = os.path.join(snapshot_dir, 'blueprints.bin')
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import server as _server
+    server = _server
+
+    client.drop_database(database_name)
+    database = client[database_name]
+
+    # explain() needs the collections to exist, one document each is enough
+    for name in set(check[1] for check in server.query_plan_checks):
+        database[name].insert({'_query_plan_check': True})
+
+    server.ensure_indexes(database=database)
+
+def tearDownModule():
+
+    if database is not None:
+        client.drop_database(database_name)
+
+    if snapshot_dir is not None:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+class QueryPlanTest(unittest.TestCase):
+
+    def test_queries_use_an_index(self):
+
+        for description, name, query, sort in server.query_plan_checks:
+            with self.subTest(description):
+                self.assertFalse(server.query_scans_collection(database[name], query, sort), "query on %s scans the whole collection" % name)
+
+    def test_check_query_plans(self):
+        self.assertEqual(server.check_query_plans(database), [])
+
+    # Makes sure the plan inspection actually notices a collection scan
+    def test_unindexed_query_scans_collection(self):
+        self.assertTrue(server.query_scans_collection(database.settings, {'_query_plan_check': True}))
+
+    def test_missing_collection_fails(self):
+
+        missing = client[database_name + '_missing']
+
+        try:
+            failures = server.check_query_plans(missing)
+        finally:
+            client.drop_database(database_name + '_missing')
+
+        self.assertEqual(len(failures), len(server.query_plan_checks))
+
+if __name__ == '__main__':
+    unittest.main()